@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark harness for process_cal2.py.
+
+Generates synthetic calendar/circuits/broadcasters XML files in the A#2 schema (with the field order
+shuffled per event, as in 2022-season-testing.xml) and times each stage of the single-query pipeline separately.
+Results are printed as JSON so they can be stored and compared between versions.
+
+Usage:
+    python3 bench_cal2.py --sizes=1000,100000 [--repeat=3] [--seed=265] [--output=results.json] [--keep=DIR]
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import datetime
+from typing import Callable, Dict, Tuple
+
+import core_cal2
+import stream_cal2
+
+EVENT_FIELDS = ["id", "description", "location", "day", "month", "year", "start", "end", "broadcaster"]
+SESSIONS = ["Practice 1", "Practice 2", "Practice 3", "Qualifying", "Sprint", "Race"]
+FIRST_DAY = datetime.date(2020, 1, 1).toordinal()
+LAST_DAY = datetime.date(2025, 12, 31).toordinal()
+
+
+def generate_files(directory: str,
+                   events: int,
+                   circuits: int = 50,
+                   broadcasters: int = 20,
+                   seed: int = 265) -> Tuple[str, str, str]:
+    """ Writes synthetic input files, streaming events so any size fits in memory.
+            Input: output directory, number of events, circuits and broadcasters, random seed
+            Output: events, circuits and broadcasters filenames
+    """
+    rng = random.Random(seed)
+    event_filename = os.path.join(directory, f"calendar-{events}.xml")
+    circuit_filename = os.path.join(directory, "circuits.xml")
+    broadcaster_filename = os.path.join(directory, "broadcasters.xml")
+
+    with open(circuit_filename, "w") as file:
+        file.write("<circuits>\n")
+        for i in range(1, circuits + 1):
+            file.write("    <circuit>\n"
+                       f"        <id>CI{i:04d}</id>\n"
+                       f"        <name>Circuit {i}</name>\n"
+                       f"        <location>City {i}, Country {i % 40}</location>\n"
+                       f"        <timezone>GMT{rng.randint(-11, 12):+d}</timezone>\n"
+                       f"        <direction>{rng.choice(['clockwise', 'anti-clockwise'])}</direction>\n"
+                       "    </circuit>\n")
+        file.write("</circuits>\n")
+
+    with open(broadcaster_filename, "w") as file:
+        file.write("<broadcasters>\n")
+        for i in range(1, broadcasters + 1):
+            file.write("    <broadcaster>\n"
+                       f"        <id>BR{i:04d}</id>\n"
+                       f"        <name>Broadcaster {i}</name>\n"
+                       f"        <cost>{rng.randint(10, 300)}.99 CAD/year</cost>\n"
+                       "    </broadcaster>\n")
+        file.write("</broadcasters>\n")
+
+    with open(event_filename, "w") as file:
+        file.write("<calendar>\n")
+        buffer = []
+        for i in range(1, events + 1):
+            date = datetime.date.fromordinal(rng.randint(FIRST_DAY, LAST_DAY))
+            start = rng.randint(0, 20 * 60)
+            end = min(start + rng.randint(60, 180), 23 * 60 + 59)
+            ids = rng.sample(range(1, broadcasters + 1), rng.randint(1, min(3, broadcasters)))
+            fields = {
+                "id": f"EV{i:08d}",
+                "description": f"FORMULA 1 GRAND PRIX {date.year} #{rng.randint(1, 500)} - {rng.choice(SESSIONS)}",
+                "location": f"CI{rng.randint(1, circuits):04d}",
+                "day": f"{date.day:02d}",
+                "month": f"{date.month:02d}",
+                "year": str(date.year),
+                "start": f"{start // 60:02d}:{start % 60:02d}",
+                "end": f"{end // 60:02d}:{end % 60:02d}",
+                "broadcaster": ",".join(f"BR{id:04d}" for id in ids),
+            }
+            order = EVENT_FIELDS[:]
+            rng.shuffle(order)
+            buffer.append("    <event>\n")
+            buffer.extend(f"        <{tag}>{fields[tag]}</{tag}>\n" for tag in order)
+            buffer.append("    </event>\n")
+            if len(buffer) >= 64 * 1024:
+                file.write("".join(buffer))
+                buffer = []
+        file.write("".join(buffer))
+        file.write("</calendar>\n")
+
+    return event_filename, circuit_filename, broadcaster_filename
+
+
+def timed(function: Callable, *args) -> Tuple[object, float]:
+    """ Calls function(*args) and measures it.
+            Output: (return value, wall time in seconds)
+    """
+    began = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - began
+
+
+def bench_once(files: Tuple[str, str, str],
+               start: datetime.datetime,
+               end: datetime.datetime,
+               output: str) -> Dict[str, float]:
+    """ Runs the shipped single-query pipeline once (see stream_cal2.stream_query), timing each stage on its own:
+        the windowed parse (iter_events with its date pushdown and inline decoding, then window_filter),
+        the bounded sort, the reference checks and the YAML writer. The lazy stages are drained into lists
+        between timings, so the stages add up to slightly more than the fused pipeline.
+            Input: events/circuits/broadcasters filenames, query window, YAML output path
+            Output: dict of stage name to seconds
+    """
+    event_filename, circuit_filename, broadcaster_filename = files
+    window = (core_cal2.to_minutes(start), core_cal2.to_minutes(end))
+    stages = {}
+
+    def parse() -> list:
+        with open(event_filename, "rb") as file:
+            return list(stream_cal2.window_filter(core_cal2.iter_events(file, window), window))
+
+    events, stages["parse"] = timed(parse)
+    events, stages["sort"] = timed(lambda: list(stream_cal2.sort_events(events)))
+    circuits = core_cal2.build_index(core_cal2.parse_file(circuit_filename), "circuit")
+    broadcasters = core_cal2.build_index(core_cal2.parse_file(broadcaster_filename), "broadcaster")
+    _, stages["references"] = timed(core_cal2.validate_references, events, circuits, broadcasters)
+    _, stages["write_file"] = timed(core_cal2.write_file, events, circuits, broadcasters, output)
+    stages["total"] = sum(stages.values())
+
+    return stages
+
+
+def bench_size(directory: str, size: int, repeat: int, seed: int) -> dict:
+    """ Generates inputs of one size and benchmarks them, keeping the best time per stage.
+            Input: working directory, number of events, number of repetitions, random seed
+            Output: result dict for the JSON report
+    """
+    files, generate = timed(generate_files, directory, size, 50, 20, seed)
+    start = datetime.datetime(2021, 1, 1)
+    end = datetime.datetime(2024, 12, 31)
+    output = os.path.join(directory, f"output-{size}.yaml")
+
+    runs = [bench_once(files, start, end, output) for _ in range(repeat)]
+    best = {stage: min(run[stage] for run in runs) for stage in runs[0]}
+
+    return {
+        "events": size,
+        "input_bytes": os.path.getsize(files[0]),
+        "output_bytes": os.path.getsize(output),
+        "generate_seconds": generate,
+        "seconds": best,
+        "events_per_second": size / best["total"] if best["total"] else None,
+    }
+
+
+def main():
+    """ The main entry point for the benchmark.
+    """
+    options = core_cal2.parse_options(sys.argv[1:])
+    sizes = [int(size) for size in options.get("sizes", "1000,10000,100000").split(",")]
+    repeat = int(options.get("repeat") or 3)
+    seed = int(options.get("seed") or 265)
+
+    directory = options.get("keep") or tempfile.mkdtemp(prefix="bench_cal2-")
+    os.makedirs(directory, exist_ok=True)
+    try:
+        results = [bench_size(directory, size, repeat, seed) for size in sizes]
+    finally:
+        if not options.get("keep"):
+            shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "repeat": repeat,
+        "seed": seed,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+
+    if options.get("output"):
+        with open(options["output"], "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
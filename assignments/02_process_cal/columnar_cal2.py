@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar binary calendars for process_cal2.
+
+"process_cal2.py export" writes the parsed events and reference data to one file (export_columnar) that later
+runs pass as --events and open in place through a memory map (ColumnarIndex), instead of parsing XML again.
+"""
+import sys
+import mmap
+import array
+import bisect
+import struct
+import datetime
+from typing import BinaryIO, Dict, Iterator, List
+
+from core_cal2 import Event, build_index, to_minutes
+
+COLUMNAR_MAGIC = b"CAL2COL\0"
+COLUMNAR_VERSION = 1
+COLUMNAR_HEADER = struct.Struct("<8sIIIQIIq")
+EVENT_STRING_FIELDS = ("id", "description", "location", "broadcaster")
+
+
+def export_columnar(filename: str,
+                    events: List[Event],
+                    circuits: Dict[str, dict],
+                    broadcasters: Dict[str, dict]) -> None:
+    """ Writes events (sorted by start) and reference data as a columnar binary calendar (see ColumnarIndex).
+        All strings go into one interned table; events become fixed-width columns of timestamps and string numbers.
+            Input: output filename, sorted list of Events, circuit and broadcaster indexes
+    """
+    strings = {}
+
+    def intern(value: str) -> int:
+        number = strings.get(value)
+        if number is None:
+            number = strings[value] = len(strings)
+        return number
+
+    columns = [array.array("q", [event.start for event in events]),
+               array.array("q", [event.end for event in events])]
+    for field in EVENT_STRING_FIELDS:
+        columns.append(array.array("I", [intern(getattr(event, field)) for event in events]))
+    references = []
+    for items in (circuits, broadcasters):
+        words = array.array("I")
+        for item in items.values():
+            words.append(len(item))
+            for key, value in item.items():
+                words.extend((intern(key), intern(value)))
+        references.append(words)
+
+    encoded = [value.encode() for value in strings]
+    offsets = array.array("Q", [0])
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+    blob = b"".join(encoded)
+
+    longest = max((event.end - event.start for event in events), default=0)
+    header = COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, COLUMNAR_VERSION, len(events), len(strings), len(blob),
+                                  len(references[0]), len(references[1]), longest)
+    sections = [offsets] + columns + references
+    if sys.byteorder != "little":
+        for section in sections:
+            section.byteswap()
+
+    with open(filename, "wb") as file:
+        write_aligned(file, header)
+        for section in sections:
+            write_aligned(file, section.tobytes())
+        write_aligned(file, blob)
+
+
+def write_aligned(file: BinaryIO, data: bytes) -> None:
+    """ Writes data followed by zero padding up to the next multiple of 8 bytes.
+            Input: binary file object, bytes
+    """
+    file.write(data)
+    file.write(bytes(-len(data) % 8))
+
+
+def is_columnar(filename: str) -> bool:
+    """ Tells whether a file is a columnar binary calendar (see export_columnar).
+            Input: filename string
+            Output: bool
+    """
+    try:
+        with open(filename, "rb") as file:
+            return file.read(len(COLUMNAR_MAGIC)) == COLUMNAR_MAGIC
+    except OSError:
+        return False
+
+
+class ColumnarIndex:
+    """ Read-only view of a columnar binary calendar, answering the same queries as EventIndex.
+        The file is memory-mapped and its columns are used in place, so opening it costs almost nothing;
+        Events are only built for the rows a query returns.
+
+        Layout (little endian, each section padded to 8 bytes): header (COLUMNAR_HEADER), string end
+        offsets (u64, one leading 0 plus one per string), start and end minute ordinals (i64 per event,
+        sorted by start), id/description/location/broadcaster string numbers (u32 per event), circuit and
+        broadcaster records (u32 words: field count, then key/value string numbers), UTF-8 string data.
+    """
+
+    def __init__(self, filename: str) -> None:
+        """ Input: filename string
+        """
+        self.filename = filename
+        with open(filename, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+
+        magic, version, count, nstrings, nbytes, ncircuits, nbroadcasters, self.longest = \
+            COLUMNAR_HEADER.unpack_from(view)
+        if magic != COLUMNAR_MAGIC or version != COLUMNAR_VERSION:
+            raise ValueError(f"{filename} is not a version {COLUMNAR_VERSION} columnar calendar")
+
+        pos = COLUMNAR_HEADER.size + -COLUMNAR_HEADER.size % 8
+        sections = []
+        for code, size in [("Q", nstrings + 1), ("q", count), ("q", count)] + [("I", count)] * len(
+                EVENT_STRING_FIELDS) + [("I", ncircuits), ("I", nbroadcasters)]:
+            section = view[pos:pos + size * array.array(code).itemsize]
+            if sys.byteorder != "little":
+                section = array.array(code, section.tobytes())
+                section.byteswap()
+            else:
+                section = section.cast(code)
+            sections.append(section)
+            pos += len(section) * array.array(code).itemsize
+            pos += -pos % 8
+        self.blob = view[pos:pos + nbytes]
+
+        self.offsets, self.starts, self.ends = sections[:3]
+        self.fields = sections[3:3 + len(EVENT_STRING_FIELDS)]
+        self.strings = [None] * nstrings
+        self.circuits = self.read_records(sections[-2])
+        self.broadcasters = self.read_records(sections[-1])
+
+    def __getstate__(self) -> dict:
+        return {"filename": self.filename}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["filename"])
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    @property
+    def events(self) -> List[Event]:
+        """ Every stored Event, sorted by start.
+        """
+        return [self.event(row) for row in range(len(self))]
+
+    def string(self, number: int) -> str:
+        """ Decodes one string of the table, once.
+                Input: string number
+                Output: str
+        """
+        value = self.strings[number]
+        if value is None:
+            value = self.strings[number] = str(self.blob[self.offsets[number]:self.offsets[number + 1]], "utf-8")
+        return value
+
+    def read_records(self, words) -> Dict[str, dict]:
+        """ Decodes circuit or broadcaster records into an id -> dict index (see build_index).
+                Input: u32 words of one reference section
+                Output: dict keyed by each record's id
+        """
+        items = []
+        pos = 0
+        while pos < len(words):
+            size = words[pos]
+            items.append({self.string(words[pos + 1 + 2 * i]): self.string(words[pos + 2 + 2 * i])
+                          for i in range(size)})
+            pos += 1 + 2 * size
+        return build_index(items, "record")
+
+    def event(self, row: int) -> Event:
+        """ Builds the Event stored in one row.
+                Input: row number
+                Output: Event
+        """
+        return Event(*[self.string(column[row]) for column in self.fields], self.starts[row], self.ends[row])
+
+    def iter_window(self, start: datetime.datetime, end: datetime.datetime,
+                    overlap: bool = False) -> Iterator[Event]:
+        """ Lazily yields the rows of range (or overlapping), building one Event at a time.
+                Input: start datetime object, end datetime object, whether to include overlapping events
+                Output: generator of Events sorted by start
+        """
+        first = to_minutes(start)
+        lo = bisect.bisect_right(self.starts, first - self.longest if overlap else first)
+        hi = bisect.bisect_left(self.starts, to_minutes(end), lo)
+        for row in range(lo, hi):
+            if first < self.starts[row] or (overlap and first < self.ends[row]):
+                yield self.event(row)
+
+    def range(self, start: datetime.datetime, end: datetime.datetime) -> List[Event]:
+        """ Same as EventIndex.range.
+        """
+        lo = bisect.bisect_right(self.starts, to_minutes(start))
+        hi = bisect.bisect_left(self.starts, to_minutes(end), lo)
+        return [self.event(row) for row in range(lo, hi)]
+
+    def overlapping(self, start: datetime.datetime, end: datetime.datetime) -> List[Event]:
+        """ Same as EventIndex.overlapping.
+        """
+        start = to_minutes(start)
+        lo = bisect.bisect_right(self.starts, start - self.longest)
+        hi = bisect.bisect_left(self.starts, to_minutes(end), lo)
+        return [self.event(row) for row in range(lo, hi)
+                if start < self.starts[row] or start < self.ends[row]]
+
@@ -0,0 +1,954 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parsing, indexing and YAML rendering for process_cal2.
+
+Reads the XML events, circuits and broadcasters (no XML or YAML modules, see process_cal2.py), keeps the events
+in a sorted EventIndex and writes date windows of it as YAML. The streaming query (stream_cal2), the columnar
+calendar (columnar_cal2) and the profiler (profile_cal2) are built on top of it. Modules only some runs need
+(pickle, mmap, process pools...) are imported by the functions that use them, so a plain query starts fast.
+"""
+import os
+import sys
+import heapq
+import bisect
+import functools
+import datetime
+import re  # regular expressions
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple, Union
+
+CHUNK_SIZE = 64 * 1024
+CACHE_DIR = ".cal2cache"
+CACHE_VERSION = 6
+HASH_BLOCK_SIZE = 1024 * 1024
+MMAP_RELEASE_SIZE = 8 * 1024 * 1024
+BATCH_PARALLEL_JOBS = 16
+PARALLEL_RENDER_EVENTS = 100000
+RENDER_CHUNK_EVENTS = 20000
+MAX_REPORTED_REFERENCES = 20
+ROOT_TAG = re.compile(rb"<([a-z]+)>")
+FIELD = re.compile(rb"<([a-z]+)>(.*?)</\1>", re.DOTALL)
+YEAR = re.compile(rb"<year>\s*(\d+)\s*</year>")
+MONTH = re.compile(rb"<month>\s*(\d+)\s*</month>")
+DAY = re.compile(rb"<day>\s*(\d+)\s*</day>")
+ENCODED_FIELDS = frozenset(["location", "broadcaster", "year", "month", "day", "start", "end"])
+RECORD_TAGS = {b"calendar": b"event", b"circuits": b"circuit", b"broadcasters": b"broadcaster"}
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+DAY_HEADER = "\n  - %d-%m-%Y:"
+LONG_DAY = "%A, %B %d, %Y"
+CLOCK = "%I:%M %p"
+MINUTES_PER_DAY = 24 * 60
+DAY_CACHE_SIZE = 4096
+UTC_OFFSET = re.compile(r"(?:GMT|UTC)(?:([+-])(\d{1,2})(?::?(\d{2}))?)?", re.IGNORECASE)
+EVENT_TEMPLATE = ("\n    - id: {id}"
+                  "\n      description: {description}"
+                  "\n      circuit: {name} ({direction})"
+                  "\n      location: {location}"
+                  "\n      when: {start} - {end} {day} ({timezone})"
+                  "\n      broadcasters:{broadcasters}")
+
+
+def parse_args(args: List[str]) -> List[str]:
+    """ Parses input arguments according to specified format.
+    """
+    options = parse_options(args[1:])
+
+    start = parse_date(options["start"])
+    end = parse_date(options["end"])
+
+    events = options["events"]
+    circuits = options.get("circuits")
+    broadcasters = options.get("broadcasters")
+
+    return (start, end, events, circuits, broadcasters)
+
+
+def parse_options(args: List[str]) -> Dict[str, str]:
+    """ Splits "--key=value" arguments into a dict; bare "--flag" arguments map to "".
+            Input: list of argument strings (without the program name)
+            Output: dict of option names to values
+    """
+    options = {}
+
+    for arg in args:
+        key, _, value = arg[2:].partition("=")
+        options[key] = value
+
+    return options
+
+
+def parse_date(date: str) -> datetime.datetime:
+    """ Converts a "yyyy/mm/dd" string to a datetime object.
+            Input: date string
+            Output: datetime at midnight of that date
+    """
+    y, m, d = date.split("/")
+    return datetime.datetime(int(y), int(m), int(d))
+
+
+def parse_files(event_filename: str,
+                circuit_filename: str,
+                broadcaster_filename: str,
+                cache: Optional[str] = None,
+                window: Optional[Tuple[int, int]] = None,
+                use_mmap: bool = False) -> Tuple[List["Event"], List[dict], List[dict]]:
+    """ Entry point to file parsing scheme.
+            Input: filename strings for events (comma-separated names or globs), circuits, and broadcasters;
+                   cache directory ("" for a .cal2cache folder next to each file, None to disable caching);
+                   optional (start, end) minute ordinals outside of which events may be skipped, and whether
+                   to scan events files through mmap (both only apply without a cache, which holds full parses)
+            Output: list of Events sorted by start, lists of dicts representing circuits and broadcasters
+    """
+    events = parse_event_files(expand_filenames(event_filename), cache, window, use_mmap)
+    circuits = load_cached(circuit_filename, parse_file, cache)
+    broadcasters = load_cached(broadcaster_filename, parse_file, cache)
+
+    return events, circuits, broadcasters
+
+
+def expand_filenames(spec: str) -> List[str]:
+    """ Expands a comma-separated list of filenames and glob patterns.
+            Input: filename specification string, e.g. "testing.xml,feeds/*.xml"
+            Output: list of filenames, each pattern's matches in sorted order
+    """
+    import glob
+
+    filenames = []
+
+    for part in spec.split(","):
+        if glob.has_magic(part):
+            matches = sorted(glob.glob(part))
+            if not matches:
+                raise FileNotFoundError(f"no events files match {part}")
+            filenames.extend(matches)
+        else:
+            filenames.append(part)
+
+    return filenames
+
+
+def parse_event_files(filenames: List[str],
+                      cache: Optional[str] = None,
+                      window: Optional[Tuple[int, int]] = None,
+                      use_mmap: bool = False) -> List["Event"]:
+    """ Parses several events files, one worker process per file, and k-way merges the sorted results.
+            Input: list of events filenames, cache directory, window and mmap flag (see parse_files)
+            Output: list of Events sorted by start; ties keep file order, then order within a file
+    """
+    if cache is not None:
+        load = functools.partial(load_cached, parse=parse_events, cache=cache)
+    else:
+        load = functools.partial(parse_events, window=window, use_mmap=use_mmap)
+
+    if len(filenames) == 1:
+        return load(filenames[0])
+
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(min(len(filenames), os.cpu_count() or 1)) as pool:
+        streams = list(pool.map(load, filenames))
+
+    return merge_events(filenames, streams)
+
+
+def merge_events(filenames: List[str], streams: List[List["Event"]]) -> List["Event"]:
+    """ K-way merges per-file sorted event lists, rejecting event ids that appear in more than one file.
+            Input: list of filenames, list of each file's sorted Events (same order)
+            Output: list of Events sorted by start; ties keep file order, then order within a file
+    """
+    owners = {}
+    for i, stream in enumerate(streams):
+        for event in stream:
+            owner = owners.setdefault(event.id, i)
+            if owner != i:
+                raise ValueError(f"duplicate event id {event.id} in {filenames[owner]} and {filenames[i]}")
+
+    return list(heapq.merge(*streams, key=get_date))
+
+
+def parse_events(filename: str,
+                 window: Optional[Tuple[int, int]] = None,
+                 use_mmap: bool = False) -> List["Event"]:
+    """ Parses an events file straight into Event records.
+            Input: filename string, optional (start, end) minute ordinals (events on days entirely outside
+                   the window may be dropped), whether to scan the file through mmap (see scan_events_mmap)
+            Output: list of Events sorted by start
+    """
+    if use_mmap:
+        events = scan_events_mmap(filename, window)
+    else:
+        with open(filename, "rb") as file:
+            events = list(iter_events(file, window))
+    events.sort(key=get_date)
+    return events
+
+
+def iter_events(file: BinaryIO, window: Optional[Tuple[int, int]] = None) -> Iterator["Event"]:
+    """ Streams Events out of an events file. With a window, an event stops being built as soon as its
+        <year>, <month> and <day> show it falls on a day outside the window (see day_in_window),
+        and the tokenizer moves on to the next <event>.
+            Input: binary file object, optional (start, end) minute ordinals
+            Output: generator of Events in file order
+    """
+    strings = {}
+    for buff, begin, end, _ in scan_spans(file):
+        item = {}
+        pending = window is not None
+        for field in FIELD.finditer(buff, begin, end):
+            # decode_field, inlined on this hot path
+            tag, data = field.group(1, 2)
+            key = strings.get(tag)
+            if key is None:
+                key = strings[tag] = tag.decode()
+            if key in ENCODED_FIELDS:
+                value = strings.get(data)
+                if value is None:
+                    value = strings[data] = data.decode()
+            else:
+                value = data.decode()
+            item[key] = value
+            if pending and "year" in item and "month" in item and "day" in item:
+                pending = False
+                date = datetime.date(int(item["year"]), int(item["month"]), int(item["day"]))
+                if not day_in_window(date, window):
+                    break
+        else:
+            yield make_event(item)
+
+
+def scan_events_mmap(filename: str, window: Optional[Tuple[int, int]] = None) -> List["Event"]:
+    """ Scans an events file in place through a memory map (see iter_events_mmap).
+            Input: filename string, optional (start, end) minute ordinals
+            Output: list of Events in file order
+    """
+    return list(iter_events_mmap(filename, window))
+
+
+def iter_events_mmap(filename: str, window: Optional[Tuple[int, int]] = None) -> Iterator["Event"]:
+    """ Streams Events out of a memory-mapped events file, decoding only events whose day can overlap the window
+        and releasing scanned pages every MMAP_RELEASE_SIZE bytes.
+            Input: filename string, optional (start, end) minute ordinals
+            Output: generator of Events in file order
+    """
+    import mmap
+
+    strings = {}
+
+    with open(filename, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            root = ROOT_TAG.search(view)
+            if root is None:
+                return
+            if RECORD_TAGS.get(root.group(1)) != b"event":
+                raise ValueError(f"{filename} is not an events file")
+
+            release = getattr(view, "madvise", None) if hasattr(mmap, "MADV_DONTNEED") else None
+            if release is not None and hasattr(mmap, "MADV_SEQUENTIAL"):
+                release(mmap.MADV_SEQUENTIAL)
+            released = 0
+
+            pos = root.end()
+            while True:
+                begin = view.find(b"<event>", pos)
+                if begin == -1:
+                    break
+                end = view.find(b"</event>", begin)
+                if end == -1:
+                    break
+                pos = end + len(b"</event>")
+
+                if release is not None and begin - released >= MMAP_RELEASE_SIZE:
+                    done = begin - begin % mmap.PAGESIZE
+                    release(mmap.MADV_DONTNEED, released, done - released)
+                    released = done
+
+                if window is not None:
+                    year = YEAR.search(view, begin, end)
+                    month = MONTH.search(view, begin, end)
+                    day = DAY.search(view, begin, end)
+                    if year and month and day and not day_in_window(
+                            datetime.date(int(year.group(1)), int(month.group(1)), int(day.group(1))), window):
+                        continue
+
+                item = {}
+                for field in FIELD.finditer(view, begin + len(b"<event>"), end):
+                    populate_dict(*decode_field(field.group(1), field.group(2), strings), item)
+                yield make_event(item)
+
+
+def day_in_window(date: datetime.date, window: Tuple[int, int]) -> bool:
+    """ Tells whether an event on this date can start or end inside a window. Events start and end on
+        the same day, so this only rejects days lying completely outside it.
+            Input: date object, (start, end) minute ordinals
+            Output: bool
+    """
+    day = date.toordinal() * MINUTES_PER_DAY
+    return day < window[1] and window[0] < day + MINUTES_PER_DAY
+
+
+def load_cached(filename: str, parse: Callable[[str], list], cache: Optional[str]) -> list:
+    """ Returns parse(filename), reusing a pickled result (key, then payload) while the file's mtime and size
+        are unchanged. Events are stored as tuples (see event_rows), with a checkpoint for appended events
+        (see resume_events).
+            Input: filename string, parsing function, cache directory ("" for .cal2cache next to the file,
+                   None to always parse)
+            Output: the parsed list
+    """
+    if cache is None:
+        return parse(filename)
+
+    import pickle
+    import hashlib
+    import tempfile
+
+    path = os.path.abspath(filename)
+    directory = cache or os.path.join(os.path.dirname(path), CACHE_DIR)
+    entry = os.path.join(directory, hashlib.sha1(path.encode()).hexdigest()[:16] + ".pickle")
+    key = cache_key(path)
+
+    cached = None
+    try:
+        with open(entry, "rb") as file:
+            cached_key = pickle.load(file)
+            # an outdated entry is still worth loading for its checkpoint
+            if cached_key == key or (parse is parse_events and cached_key[:2] == key[:2]):
+                cached = pickle.load(file)
+        if cached_key == key:
+            return events_from_rows(cached["data"]) if parse is parse_events else cached["data"]
+    except (OSError, EOFError, pickle.UnpicklingError, KeyError, TypeError, AttributeError):
+        cached = None
+
+    checkpoint = None
+    if parse is parse_events:
+        if cached is not None and cached.get("checkpoint"):
+            checkpoint = (events_from_rows(cached["data"]),) + cached["checkpoint"]
+        data, offset, digest = resume_events(filename, checkpoint)
+        checkpoint = (offset, digest)
+    else:
+        data = parse(filename)
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+        evict_stale(directory)
+        with tempfile.NamedTemporaryFile("wb", dir=directory, delete=False) as file:
+            pickle.dump(key, file, pickle.HIGHEST_PROTOCOL)
+            rows = event_rows(data) if parse is parse_events else data
+            pickle.dump({"data": rows, "checkpoint": checkpoint}, file, pickle.HIGHEST_PROTOCOL)
+        os.replace(file.name, entry)
+    except OSError:
+        pass  # caching is best effort; a read-only directory just means no cache
+
+    return data
+
+
+def resume_events(filename: str,
+                  checkpoint: Optional[Tuple[List["Event"], int, bytes]] = None) -> Tuple[List["Event"], int, bytes]:
+    """ Parses an events file, skipping the part a checkpoint already covers when those bytes are unchanged.
+        Appending events before </calendar> leaves the checkpointed prefix intact, so only the new tail is read;
+        any other edit to the prefix falls back to a full parse.
+            Input: filename string, optional (sorted Events, offset just past the last </event>, prefix digest)
+            Output: (Events sorted by start, new offset, digest of the bytes before it)
+    """
+    import hashlib
+
+    with open(filename, "rb") as file:
+        events, offset, hasher = [], 0, hashlib.blake2b()
+        if checkpoint is not None:
+            hash_range(file, hasher, 0, checkpoint[1])
+            if hasher.digest() == checkpoint[2]:
+                events, offset = checkpoint[0], checkpoint[1]
+            else:
+                hasher = hashlib.blake2b()
+
+        file.seek(offset)
+        added = []
+        end = offset
+        for record, end in scan_records(file, b"event" if offset else None):
+            added.append(make_event(record))
+        hash_range(file, hasher, offset, end)
+
+    if added:
+        # stable sort: old events already precede appended ones in file order, so ties resolve as in a full parse
+        events = sorted(events + added, key=get_date)
+
+    return events, end, hasher.digest()
+
+
+def hash_range(file: BinaryIO, hasher, start: int, end: int) -> None:
+    """ Feeds bytes start..end of a file to a hashlib object.
+            Input: binary file object, hashlib object, start and end offsets
+    """
+    file.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        block = file.read(min(remaining, HASH_BLOCK_SIZE))
+        if not block:
+            break
+        hasher.update(block)
+        remaining -= len(block)
+
+
+def cache_key(path: str) -> Tuple[int, str, int, int]:
+    """ Identifies one version of a file for the parse cache.
+            Input: absolute path string
+            Output: (cache format version, path, mtime in ns, size in bytes)
+    """
+    stat = os.stat(path)
+    return CACHE_VERSION, path, stat.st_mtime_ns, stat.st_size
+
+
+def evict_stale(directory: str) -> None:
+    """ Removes cache entries whose source file has changed or no longer exists. Only the key pickle at the
+        start of each entry is read; entries whose key cannot be read are left alone (a later write for the
+        same file replaces them).
+            Input: cache directory
+    """
+    import pickle
+
+    for name in os.listdir(directory):
+        if not name.endswith(".pickle"):
+            continue
+        entry = os.path.join(directory, name)
+        try:
+            with open(entry, "rb") as file:
+                key = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            continue
+        if isinstance(key, tuple) and len(key) == 4 and key[0] == CACHE_VERSION:
+            try:
+                if key == cache_key(key[1]):
+                    continue
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
+
+
+def parse_file(filename: str) -> List[dict]:
+    """ Parses a file and populates a list of dicts representing events, circuits, or broadcasters.
+            Input: filename string
+            Output: list of dicts filled with data from file
+    """
+    with open(filename, "rb") as file:
+        return list(iter_records(file))
+
+
+def iter_records(file: BinaryIO, chunk_size: int = CHUNK_SIZE) -> Iterator[dict]:
+    """ Streams records (<event>, <circuit> or <broadcaster>) out of an XML file one at a time.
+        The file is read in fixed-size chunks; only the current partial record is ever buffered,
+        so tags split across chunks and several elements per line are both handled.
+            Input: binary file object, chunk size in bytes
+            Output: generator of dicts, one per record
+    """
+    for item, _ in scan_records(file, chunk_size=chunk_size):
+        yield item
+
+
+def scan_records(file: BinaryIO,
+                 record: Optional[bytes] = None,
+                 chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple[dict, int]]:
+    """ Variant of iter_records that also reports where each record ends (see scan_spans).
+            Input: binary file object positioned where scanning starts, record tag name, chunk size in bytes
+            Output: generator of (dict, file offset just past the record's closing tag)
+    """
+    strings = {}
+    for buff, begin, end, offset in scan_spans(file, record, chunk_size):
+        item = {}
+        for field in FIELD.finditer(buff, begin, end):
+            populate_dict(*decode_field(field.group(1), field.group(2), strings), item)
+        yield item, offset
+
+
+def scan_spans(file: BinaryIO,
+               record: Optional[bytes] = None,
+               chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple[bytes, int, int, int]]:
+    """ The chunked tokenizer itself: finds record boundaries without looking at the fields.
+        Without a record tag, it is chosen from the root element; with one, scanning may start
+        at any offset between records (see resume_events).
+            Input: binary file object positioned where scanning starts, record tag name, chunk size in bytes
+            Output: generator of (buffer, start and end of the record's contents in the buffer,
+                    file offset just past its closing tag); the buffer is only valid until the next item
+    """
+    base = file.tell()  # file offset of buff[0]
+    buff = b""
+    open_tag = close_tag = None
+    if record is not None:
+        open_tag, close_tag = b"<" + record + b">", b"</" + record + b">"
+    while True:
+        chunk = file.read(chunk_size)
+        buff += chunk
+
+        if open_tag is None:
+            root = ROOT_TAG.search(buff)
+            if root is None:
+                if not chunk:
+                    return
+                continue
+            record = RECORD_TAGS.get(root.group(1))
+            if record is None:
+                raise ValueError(f"unknown root element <{root.group(1).decode()}>")
+            open_tag, close_tag = b"<" + record + b">", b"</" + record + b">"
+            base += root.end()
+            buff = buff[root.end():]
+
+        pos = 0
+        while True:
+            begin = buff.find(open_tag, pos)
+            if begin == -1:
+                break
+            end = buff.find(close_tag, begin)
+            if end == -1:
+                break
+            pos = end + len(close_tag)
+            yield buff, begin + len(open_tag), end, base + pos
+
+        # keep only an unfinished record, or enough bytes to complete a split opening tag
+        begin = buff.find(open_tag, pos)
+        keep = begin if begin != -1 else max(pos, len(buff) - len(open_tag) + 1)
+        base += keep
+        buff = buff[keep:]
+
+        if not chunk:
+            return
+
+
+def decode_field(tag: bytes, data: bytes, strings: Dict[bytes, str]) -> Tuple[str, str]:
+    """ Decodes one field through a dictionary of already decoded strings. Tag names and the values of
+        ENCODED_FIELDS repeat across records, so each distinct one is decoded once and every record shares
+        the same str object; other values (descriptions, ids) are decoded as they come.
+            Input: tag name bytes, value bytes, dictionary shared by all records of a file
+            Output: tag name and value strings
+    """
+    key = strings.get(tag)
+    if key is None:
+        key = strings[tag] = tag.decode()
+    if key not in ENCODED_FIELDS:
+        return key, data.decode()
+    value = strings.get(data)
+    if value is None:
+        value = strings[data] = data.decode()
+    return key, value
+
+
+def populate_dict(tag: str, data: str, dict: dict) -> None:
+    """ Sets a the value of <tag> key to <data> value in dict.
+            Input: key (tag) string, data (value) string, dict to be set
+            Output: none
+    """
+    tag = tag.strip("<>")
+    dict[tag] = data
+
+class Event:
+    """ One calendar event. start and end are minute ordinals (see to_minutes), so filtering,
+        sorting and day grouping work on plain integers.
+    """
+    __slots__ = ("id", "description", "location", "broadcaster", "start", "end")
+
+    def __init__(self, id: str, description: str, location: str, broadcaster: str,
+                 start: int, end: int) -> None:
+        self.id = id
+        self.description = description
+        self.location = location
+        self.broadcaster = broadcaster
+        self.start = start
+        self.end = end
+
+    def __repr__(self) -> str:
+        return f"Event({self.id!r}, start={self.start}, end={self.end})"
+
+
+def event_rows(events: List[Event]) -> List[Tuple[str, str, str, str, int, int]]:
+    """ Converts Events to tuples that unpickle without this module's classes.
+            Input: list of Events
+            Output: list of (id, description, location, broadcaster, start, end) tuples
+    """
+    return [(event.id, event.description, event.location, event.broadcaster, event.start, event.end)
+            for event in events]
+
+
+def events_from_rows(rows: List[Tuple[str, str, str, str, int, int]]) -> List[Event]:
+    """ Inverse of event_rows.
+            Input: list of tuples from event_rows
+            Output: list of Events
+    """
+    return [Event(*row) for row in rows]
+
+
+def make_event(record: dict) -> Event:
+    """ Builds an Event from a raw <event> record, converting 'year', 'month', 'day' and times to minute ordinals.
+            Input: dict of an event's XML fields
+            Output: Event
+    """
+    day = datetime.date(int(record["year"]), int(record["month"]), int(record["day"])).toordinal() * MINUTES_PER_DAY
+    hour, min = get_time(record["start"])
+    start = day + hour * 60 + min
+    hour, min = get_time(record["end"])
+    end = day + hour * 60 + min
+
+    return Event(record["id"], record["description"], record["location"], record["broadcaster"], start, end)
+
+
+def to_minutes(date: datetime.datetime) -> int:
+    """ Converts a datetime to a minute ordinal: minutes since 0001-01-01 00:00.
+            Input: datetime object
+            Output: int
+    """
+    return date.toordinal() * MINUTES_PER_DAY + date.hour * 60 + date.minute
+
+
+def get_time(time: str) -> Tuple[int, int]:
+    """ Splits a time string into two ints representing hours, minutes.
+            Input: time string of format "hh:mm"
+            Output: two ints for hour and minute
+    """
+    hour, min = time.split(":")
+    return int(hour), int(min)
+
+
+class EventIndex:
+    """ Events sorted by start time, answering date window queries by binary search.
+    """
+
+    def __init__(self, events: List[Event]) -> None:
+        """ Input: list of Events
+        """
+        self.events = sorted(events, key=get_date)
+        self.starts = [event.start for event in self.events]
+        self.longest = max((event.end - event.start for event in self.events), default=0)
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+    def range(self, start: datetime.datetime, end: datetime.datetime) -> List[Event]:
+        """ Finds events starting strictly between start and end, in O(log n + k).
+                Input: start datetime object, end datetime object
+                Output: sorted list of matching Events
+        """
+        lo = bisect.bisect_right(self.starts, to_minutes(start))
+        hi = bisect.bisect_left(self.starts, to_minutes(end), lo)
+        return self.events[lo:hi]
+
+    def overlapping(self, start: datetime.datetime, end: datetime.datetime) -> List[Event]:
+        """ Finds events overlapping the window: starting inside it, or still running after start.
+            Only events starting at most the longest event duration before start are inspected.
+                Input: start datetime object, end datetime object
+                Output: sorted list of matching Events
+        """
+        start = to_minutes(start)
+        lo = bisect.bisect_right(self.starts, start - self.longest)
+        hi = bisect.bisect_left(self.starts, to_minutes(end), lo)
+        return [event for event in self.events[lo:hi] if start < event.start or start < event.end]
+
+
+def get_date(event: Event) -> int:
+    """ Sort key for events: their start minute ordinal.
+    """
+    return event.start
+
+
+
+def build_index(items: List[dict], kind: str) -> Dict[str, dict]:
+    """ Builds an id -> record lookup table for circuits or broadcasters.
+            Input: list of 'circuit' or 'broadcaster' dicts, kind name used in error messages
+            Output: dict keyed by each record's id
+    """
+    index = {}
+
+    for item in items:
+        id = item["id"]
+        if id in index:
+            raise ValueError(f"duplicate {kind} id {id}")
+        index[id] = item
+
+    return index
+
+
+def validate_references(events: List[Event],
+                        circuits: Dict[str, dict],
+                        broadcasters: Dict[str, dict]) -> None:
+    """ Checks that every circuit and broadcaster an event refers to exists.
+            Input: list of Events, circuit index, broadcaster index
+            Output: none; raises ValueError listing the first MAX_REPORTED_REFERENCES dangling references
+                    and counting the rest
+    """
+    dangling = []
+    checked = {}  # broadcaster list string -> missing ids, so each distinct list is split once
+
+    for event in events:
+        if event.location not in circuits:
+            dangling.append(f"{event.id} -> circuit {event.location}")
+        missing = checked.get(event.broadcaster)
+        if missing is None:
+            missing = checked[event.broadcaster] = [id for id in event.broadcaster.split(",")
+                                                    if id not in broadcasters]
+        for id in missing:
+            dangling.append(f"{event.id} -> broadcaster {id}")
+
+    if dangling:
+        message = "dangling references: " + ", ".join(dangling[:MAX_REPORTED_REFERENCES])
+        if len(dangling) > MAX_REPORTED_REFERENCES:
+            message += f" and {len(dangling) - MAX_REPORTED_REFERENCES} more"
+        raise ValueError(message)
+
+
+def write_file(events: Iterable[Event],
+               circuits: Dict[str, dict],
+               broadcasters: Dict[str, dict],
+               output: Union[str, TextIO] = "./output.yaml",
+               workers: Optional[int] = None) -> None:
+    """ Writes all formatted calendar data to output.yaml (or another path, "-" for stdout, or an open file).
+            Input: list of Events, circuit and broadcaster indexes from build_index, output destination,
+                   number of rendering processes (see emit_events)
+    """
+    if not isinstance(output, str):
+        emit_events(events, circuits, broadcasters, output, workers)
+    elif output == "-":
+        emit_events(events, circuits, broadcasters, sys.stdout, workers)
+        sys.stdout.flush()
+    else:
+        with open(output, "w") as file:
+            emit_events(events, circuits, broadcasters, file, workers)
+
+
+def emit_events(events: Iterable[Event],
+                circuits: Dict[str, dict],
+                broadcasters: Dict[str, dict],
+                file: TextIO,
+                workers: Optional[int] = None) -> None:
+    """ Writes the YAML for sorted events; any iterable is consumed lazily. From PARALLEL_RENDER_EVENTS events on,
+        a list is cut into chunks at day boundaries (so each chunk opens with its own day header, exactly as the
+        sequential writer would emit it) which are rendered in a process pool and written back in order.
+            Input: sorted Events, circuit and broadcaster indexes, writable text file,
+                   number of rendering processes (None or 1 to render in this process, as --workers is opt-in)
+    """
+    file.write("events:")
+    workers = workers or 1
+
+    if workers == 1 or not isinstance(events, list) or len(events) < PARALLEL_RENDER_EVENTS:
+        for block in render_blocks(events, circuits, broadcasters):
+            file.write(block)
+        return
+
+    import concurrent.futures
+
+    size = max(RENDER_CHUNK_EVENTS, len(events) // (4 * workers))
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=init_render_worker, initargs=(circuits, broadcasters)) as pool:
+        for text in pool.map(render_chunk, split_days(events, size)):
+            file.write(text)
+
+
+def split_days(events: List[Event], size: int) -> Iterator[List[Event]]:
+    """ Cuts a sorted list of events into chunks of at least size events that end on a day boundary.
+            Input: list of Events sorted by start, minimum chunk size
+            Output: generator of lists of Events
+    """
+    begin = 0
+    while begin < len(events):
+        end = min(begin + size, len(events))
+        while end < len(events) and events[end].start // MINUTES_PER_DAY == events[end - 1].start // MINUTES_PER_DAY:
+            end += 1
+        yield events[begin:end]
+        begin = end
+
+
+def init_render_worker(circuits: Dict[str, dict], broadcasters: Dict[str, dict]) -> None:
+    """ Stores the reference indexes in a rendering pool worker (see emit_events).
+    """
+    global render_state
+    render_state = (circuits, broadcasters)
+
+
+def render_chunk(events: List[Event]) -> str:
+    """ Renders one chunk of events inside a rendering pool worker.
+            Input: list of Events starting on a new day
+            Output: YAML text of the chunk
+    """
+    return "".join(render_blocks(events, *render_state))
+
+
+def render_blocks(events: Iterable[Event],
+                  circuits: Dict[str, dict],
+                  broadcasters: Dict[str, dict]) -> Iterator[str]:
+    """ Renders events through EVENT_TEMPLATE into a buffer that is handed out in large blocks.
+        Day headers and long day strings come from the format_day cache, clock times from the clock_table,
+        and circuits and broadcaster lists are joined once per distinct location and broadcaster string.
+            Input: list of Events, circuit and broadcaster indexes
+            Output: generator of YAML text blocks of about WRITE_BUFFER_SIZE characters
+    """
+    render = EVENT_TEMPLATE.format
+    clocks = clock_table()
+    places = {}  # event location -> circuit fields
+    listings = {}  # event broadcaster list string -> rendered broadcaster names
+    buffer = []
+    size = 0
+    prev_date = None
+
+    for event in events:
+        cur_date = event.start // MINUTES_PER_DAY
+        if cur_date != prev_date:
+            day = format_day(cur_date)
+            buffer.append(day[0])
+            prev_date = cur_date
+
+        place = places.get(event.location)
+        if place is None:
+            place = places[event.location] = get_circuits(circuits, event)
+        name, location, timezone, direction = place
+        names = listings.get(event.broadcaster)
+        if names is None:
+            names = listings[event.broadcaster] = "".join(
+                ["\n        - " + broadcaster["name"] for broadcaster in get_broadcasters(broadcasters, event)])
+        text = render(id=event.id, description=event.description, name=name,
+                      direction=direction, location=location, start=clocks[event.start % MINUTES_PER_DAY],
+                      end=clocks[event.end % MINUTES_PER_DAY], day=day[1], timezone=timezone, broadcasters=names)
+        buffer.append(text)
+        size += len(text)
+
+        if size >= WRITE_BUFFER_SIZE:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+
+    yield "".join(buffer)
+
+
+@functools.lru_cache(maxsize=DAY_CACHE_SIZE)
+def format_day(ordinal: int) -> Tuple[str, str]:
+    """ Formats a date once for all the renders in this process.
+            Input: proleptic Gregorian ordinal of the date
+            Output: (day header line, long day string)
+    """
+    date = datetime.date.fromordinal(ordinal)
+    return date.strftime(DAY_HEADER), date.strftime(LONG_DAY)
+
+
+@functools.lru_cache(maxsize=None)
+def clock_table() -> Tuple[str, ...]:
+    """ Formats every minute of the day once, on the first render of the process.
+            Output: tuple of CLOCK strings indexed by minute of the day
+    """
+    return tuple(datetime.time(minute // 60, minute % 60).strftime(CLOCK) for minute in range(MINUTES_PER_DAY))
+
+
+def get_circuits(circuits: Dict[str, dict], event: Event) -> Tuple[str, str, str, str]:
+    """ Retrieves circuit name, location, timezone, and direction from event
+            Input: circuit index, Event
+            Output: name, location, timezone, direction of corresponding circuit to given event's location
+    """
+    circuit = circuits[event.location]
+    return circuit["name"], circuit["location"], circuit["timezone"], circuit["direction"]
+
+
+def get_broadcasters(broadcasters: Dict[str, dict], event: Event) -> List[dict]:
+    """ Retrieves broadcaster info based off event data
+            Input: broadcaster index, Event
+            Output: list of broadcaster dicts corresponding to given event's broadcasters
+    """
+    return [broadcasters[id] for id in event.broadcaster.split(",")]
+
+
+@functools.lru_cache(maxsize=None)
+def parse_utc_offset(timezone: str) -> int:
+    """ Normalizes a circuit or viewer timezone into a UTC offset.
+            Input: "GMT" or "UTC" followed by an optional signed hour offset, e.g. "GMT-5", "UTC+05:30"
+            Output: offset east of UTC in minutes
+    """
+    match = UTC_OFFSET.fullmatch(timezone.strip())
+    if match is None:
+        raise ValueError(f"unsupported timezone {timezone!r}, expected e.g. GMT-5 or UTC+05:30")
+    sign, hours, minutes = match.groups()
+    offset = int(hours or 0) * 60 + int(minutes or 0)
+    return -offset if sign == "-" else offset
+
+
+def read_jobs(filename: str) -> List[Tuple[datetime.datetime, datetime.datetime, str]]:
+    """ Reads a batch file with one "yyyy/mm/dd yyyy/mm/dd output-path" job per line.
+        Blank lines and lines starting with "#" are ignored.
+            Input: batch filename string
+            Output: list of (start, end, output path) tuples
+    """
+    jobs = []
+
+    with open(filename) as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            start, end, output = line.split(maxsplit=2)
+            jobs.append((parse_date(start), parse_date(end), output))
+
+    return jobs
+
+
+def render_window(index: EventIndex,
+                  circuits: Dict[str, dict],
+                  broadcasters: Dict[str, dict],
+                  start: datetime.datetime,
+                  end: datetime.datetime,
+                  output: Union[str, TextIO],
+                  overlap: bool = False,
+                  workers: Optional[int] = None) -> None:
+    """ Queries one date window from the index and writes it as YAML.
+            Input: event index, circuit and broadcaster indexes, start and end datetimes,
+                   output destination and number of rendering processes (see write_file),
+                   whether to include overlapping events
+    """
+    if overlap:
+        events = index.overlapping(start, end)
+    else:
+        events = index.range(start, end)
+
+    write_file(events, circuits, broadcasters, output, workers)
+
+
+def run_batch(jobs: List[Tuple[datetime.datetime, datetime.datetime, str]],
+              index: EventIndex,
+              circuits: Dict[str, dict],
+              broadcasters: Dict[str, dict],
+              overlap: bool = False,
+              workers: Optional[int] = None) -> None:
+    """ Renders many date windows from one parsed index. Once there are BATCH_PARALLEL_JOBS jobs
+        or more, they are spread over a process pool; each worker receives the index only once.
+            Input: list of (start, end, output path) jobs, event index, circuit and broadcaster indexes,
+                   whether to include overlapping events, number of worker processes (None for cpu count)
+    """
+    if len(jobs) < BATCH_PARALLEL_JOBS or workers == 1:
+        for start, end, output in jobs:
+            render_window(index, circuits, broadcasters, start, end, output, overlap)
+        return
+
+    import concurrent.futures
+
+    workers = workers or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=init_batch_worker,
+            initargs=(index, circuits, broadcasters, overlap)) as pool:
+        for _ in pool.map(render_batch_job, jobs, chunksize=max(1, len(jobs) // (4 * workers))):
+            pass
+
+
+def init_batch_worker(index: EventIndex,
+                      circuits: Dict[str, dict],
+                      broadcasters: Dict[str, dict],
+                      overlap: bool) -> None:
+    """ Stores the shared batch inputs in a pool worker (see run_batch).
+    """
+    global batch_state
+    batch_state = (index, circuits, broadcasters, overlap)
+
+
+def render_batch_job(job: Tuple[datetime.datetime, datetime.datetime, str]) -> None:
+    """ Renders one batch job inside a pool worker.
+            Input: (start, end, output path) tuple
+    """
+    index, circuits, broadcasters, overlap = batch_state
+    start, end, output = job
+    render_window(index, circuits, broadcasters, start, end, output, overlap, workers=1)
+
@@ -11,210 +11,130 @@ CAREFUL: You ARE NOT allowed using (i.e., import) modules/libraries/packages to
 (e.g., yaml or xml modules). You will need to rely on Python collections to achieve the reading of XML files and the
 generation of YAML files.
 """
-from http.client import REQUESTED_RANGE_NOT_SATISFIABLE
+import os
 import sys
-import datetime
-import re  # regular expressions
-from typing import List, Tuple
-
-
-def parse_args(args: List[str]) -> List[str]:
-    """ Parses input arguments according to specified format.
-    """
-    startarg = args[1].lstrip("--start=")
-    y, m, d = startarg.split("/")
-    y = int(y)
-    m = int(m)
-    d = int(d)
-    start = datetime.datetime(y, m, d)
-
-    endarg = args[2].lstrip("--end=")
-    y, m, d = endarg.split("/")
-    y = int(y)
-    m = int(m)
-    d = int(d)
-    end = datetime.datetime(y, m, d)
-
-    events = re.search("--events=(.*)", args[3]).group(1)
-    circuits = re.search("--circuits=(.*)", args[4]).group(1)
-    broadcasters = re.search("--broadcasters=(.*)", args[5]).group(1)
-
-    return (start, end, events, circuits, broadcasters)
-
-
-def parse_files(event_filename: str,
-                circuit_filename: str,
-                broadcaster_filename: str) -> Tuple[List[dict], List[dict], List[dict]]:
-    """ Entry point to file parsing scheme.
-            Input: filename strings for events, circuits, and broadcasters
-            Output: three lists of dicts representing events, circuits and broadcasters
-    """
-    events = parse_file(event_filename)
-    circuits = parse_file(circuit_filename)
-    broadcasters = parse_file(broadcaster_filename)
-
-    return events, circuits, broadcasters
-
-
-def parse_file(filename: str) -> List[dict]:
-    """ Parses a file and populates a list of dicts representing events, circuits, or broadcasters.
-            Input: filename string
-            Output: list of dicts filled with data from file
-    """
-    items = []
-
-    with open(filename) as file:
-        cur = -1
-        buff = file.readline()
-        buff.rstrip()
-        buff = re.search("<[a-z]*>", buff).group()
-        lines = file.readlines()
-        for line in lines:
-            line.rstrip()
-            tag = re.search("<[a-z]*>", line)
-            if tag != None:
-                tag = tag.group()
-            if tag == "<event>" or tag == "<circuit>" or (buff == "<broadcasters>" and tag == "<broadcaster>"):
-                cur += 1
-                item = {}
-                items.append(item)
-            elif tag != None:
-                data = re.search("\>(.*?)\<", line).group(1)
-                populate_dict(tag, data, items[cur])
-
-    return items
-
-
-def populate_dict(tag: str, data: str, dict: dict) -> None:
-    """ Sets a the value of <tag> key to <data> value in dict.
-            Input: key (tag) string, data (value) string, dict to be set
-            Output: none
-    """
-    tag = tag.strip("<>")
-    dict[tag] = data
-
-def set_date(events: List[dict]) -> None:
-    """ Replaces 'year', 'month', 'day', and time parameters on each event with a datetime object
-            Input: list of 'event' dictionaries
-            Output: none
-    """
-    for event in events:
-        year = int(event["year"])
-        del event["year"]
-        month = int(event["month"])
-        del event["month"]
-        day = int(event["day"])
-        del event["day"]
-        hour, min = get_time(event["start"])
-        del event["start"]
-
-        event["date"] = datetime.datetime(year, month, day, hour, min)
-
-        hour, min = get_time(event["end"])
-        del event["end"]
-
-        event["end"] = datetime.time(hour, min)
-
-
-def get_time(time: str) -> Tuple[int, int]:
-    """ Splits a time string into two ints representing hours, minutes.
-            Input: time string of format "hh:mm"
-            Output: two ints for hour and minute
+from typing import Dict, Optional, Tuple, Union
+
+import profile_cal2
+from profile_cal2 import PROFILE_ENV, Profiler, stage
+from core_cal2 import (EventIndex, build_index, parse_args, parse_files, parse_options, read_jobs, run_batch,
+                       to_minutes, validate_references, write_file)
+from columnar_cal2 import ColumnarIndex, is_columnar
+
+
+def load_inputs(options: Dict[str, str],
+                window: Optional[Tuple[int, int]] = None) -> Tuple[Union[EventIndex, ColumnarIndex],
+                                                                   Dict[str, dict], Dict[str, dict]]:
+    """ Loads the events and reference data named by the command line options, as profiled stages.
+        A columnar binary calendar (see export_columnar) given as --events is opened in place and
+        already holds its circuits and broadcasters. With a window (a single query), event references are left
+        for the caller to check on the events it prints, as stream_query does.
+            Input: parsed command line options, optional window to push down into the parser (see parse_files)
+            Output: event index, circuit index, broadcaster index
     """
-    hour, min = time.split(":")
-    return int(hour), int(min)
+    if is_columnar(options["events"]):
+        with stage("open") as record:
+            index = ColumnarIndex(options["events"])
+            record["count"] = len(index)
+        return index, index.circuits, index.broadcasters
+
+    with stage("parse") as record:
+        events, circuits, broadcasters = parse_files(
+            options["events"], options["circuits"], options["broadcasters"], options.get("cache"),
+            window, "mmap" in options)
+        record["count"] = len(events)
+    with stage("references") as record:
+        circuits = build_index(circuits, "circuit")
+        broadcasters = build_index(broadcasters, "broadcaster")
+        if window is None:
+            validate_references(events, circuits, broadcasters)
+        record["count"] = len(circuits) + len(broadcasters)
+    with stage("index") as record:
+        index = EventIndex(events)
+        record["count"] = len(index)
+
+    return index, circuits, broadcasters
 
 
-def filter_events(events: List[dict],
-                  start: datetime.datetime,
-                  end: datetime.datetime) -> List[dict]:
-    """ Filters all 'event' dicts not within start-end from a list.
-            Input: list of 'event' dicts, start datetime object, end datetime object
-            Output: list of 'event' dicts incl. only those within times
-    """
-    filtered = []
-
-    for event in events:
-        date = event["date"]
-        if start < date and date < end:
-            filtered.append(event)
-
-    return filtered
-
-
-def write_file(events: List[dict],
-               circuits: List[dict],
-               broadcasters: List[dict]) -> None:
-    """ Writes all formatted calendar data to output.yaml.
-            Input: lists of dicts representing events, circuits, and broadcasters
-    """
-    with open("./output.yaml", "w") as file:
-        file.write("events:")
-        prev_date = 0
-
-        for event in events:
-            cur_date = event["date"].date()
-
-            if (cur_date != prev_date):
-                file.write(f'\n  - {event["date"].strftime("%d-%m-%Y:")}')
-            circuit = get_circuits(circuits, event)
-            cur_broadcasters = get_broadcasters(broadcasters, event)
-            file.write(f'\n    - id: {event["id"]}\n')
-            file.write(f'      description: {event["description"]}\n')
-            file.write(f'      circuit: {circuit[0]} ({circuit[3]})\n')
-            file.write(f'      location: {circuit[1]}\n')
-            file.write(f'      when: {event["date"].strftime("%I:%M %p")} - ')
-            file.write(f'{event["end"].strftime("%I:%M %p")} ')
-            file.write(
-                f'{event["date"].strftime("%A, %B %d, %Y")} ({circuit[2]})\n')
-            file.write('      broadcasters:')
-            for broadcaster in cur_broadcasters:
-                file.write(f'\n        - {broadcaster["name"]}')
-
-            prev_date = cur_date
-
-
-def get_circuits(circuits: List[dict], event: dict) -> Tuple[str, str, str, str]:
-    """ Retrieves circuit name, location, timezone, and direction from event
-            Input: list of 'circuit' dicts, 'event' dict
-            Output: name, location, timezone, direction of corresponding circuit to given event's location
-    """
-    id = event["location"]
-    circuit = next(
-        (circuit for circuit in circuits if circuit["id"] == id), None)
-    return circuit["name"], circuit["location"], circuit["timezone"], circuit["direction"]
-
-
-def get_broadcasters(broadcasters: List[dict], event: dict) -> List[dict]:
-    """ Retrieves broadcaster info based off event data
-            Input: list of 'broadcaster' dicts, 'event' dict
-            Output: list of broadcaster dicts corresponding to given event's broadcasters
-    """
-    ids = event["broadcaster"].split(",")
-    ids = [int(id.lstrip("BR"))-1 for id in ids]
-    actual_broadcasters = []
-
-    for id in ids:
-        broadcaster = broadcasters[id]
-        actual_broadcasters.append(broadcaster)
-
-    return actual_broadcasters
-
 
 def main():
     """ The main entry point for the program.
+        "process_cal2.py export --events=... --circuits=... --broadcasters=... --output=FILE" converts the
+        XML inputs to a columnar binary calendar, which later runs can pass as --events.
+        Profiling is enabled by --profile (summary on stderr) or --profile=trace.json (Chrome trace),
+        or by setting the PROCESS_CAL2_PROFILE environment variable to 1 or a trace filename (empty or 0 is off).
+        A single query over XML events (without --cache) runs as a stream with a bounded sort (see stream_query);
+        --stream does the same for the other inputs. --timezone=UTC+2 prints a single query in the viewer's
+        timezone instead of each circuit's local time (the query window still applies to local times).
     """
-    start, end, events, circuits, broadcasters = parse_args(sys.argv)
-
-    events, circuits, broadcasters = parse_files(
-        events, circuits, broadcasters)
-    set_date(events)
-
-    # events = filter_events(events, start, end)
-    def get_date(event): return event["date"]
-    events = sorted(filter_events(events, start, end), key=get_date)
-
-    write_file(events, circuits, broadcasters)
+    args = sys.argv[1:]
+    command = args.pop(0) if args and not args[0].startswith("--") else None
+    options = parse_options(args)
+    if command not in (None, "export"):
+        sys.exit(f"{sys.argv[0]}: unknown command {command}")
+    if options.get("timezone") and (command == "export" or "batch" in options or "serve" in options):
+        sys.exit(f"{sys.argv[0]}: --timezone only applies to a single query")
+    if "serve" in options:
+        import serve_cal2
+        serve_cal2.serve(options)
+        return
+
+    trace = options.get("profile")
+    if trace is None and os.environ.get(PROFILE_ENV, "0") not in ("", "0"):
+        trace = os.environ[PROFILE_ENV]
+    if trace is not None:
+        profile_cal2.profiler = Profiler()
+
+    window = None
+    if command is None and "batch" not in options:
+        start, end, _, _, _ = parse_args(sys.argv)
+        window = (to_minutes(start), to_minutes(end))
+    if "stream" in options and window is None:
+        sys.exit(f"{sys.argv[0]}: --stream only applies to a single query")
+
+    streaming = window is not None and ("stream" in options
+                                        or ("cache" not in options and not is_columnar(options["events"])))
+    if not streaming:
+        index, circuits, broadcasters = load_inputs(options, window)
+
+    if streaming:
+        from stream_cal2 import stream_query
+        stream_query(options, start, end)
+    elif command == "export":
+        from columnar_cal2 import export_columnar
+        with stage("export") as record:
+            export_columnar(options["output"], index.events, circuits, broadcasters)
+            record["count"] = len(index)
+    elif "batch" in options:
+        workers = int(options["workers"]) if options.get("workers") else None
+        with stage("batch") as record:
+            jobs = read_jobs(options["batch"])
+            run_batch(jobs, index, circuits, broadcasters, "overlap" in options, workers)
+            record["count"] = len(jobs)
+    else:
+        with stage("query") as record:
+            if "overlap" in options:
+                events = index.overlapping(start, end)
+            else:
+                events = index.range(start, end)
+            validate_references(events, circuits, broadcasters)
+            record["count"] = len(events)
+        if options.get("timezone"):
+            from stream_cal2 import to_timezone
+            with stage("timezone") as record:
+                # the query result is already in memory, so it is sorted there too
+                events, circuits = to_timezone(events, circuits, options["timezone"], len(events) + 1)
+                record["count"] = len(events)
+        with stage("write") as record:
+            workers = int(options["workers"]) if options.get("workers") else None
+            write_file(events, circuits, broadcasters, options.get("output") or "./output.yaml", workers)
+            record["count"] = len(events)
+
+    if profile_cal2.profiler is not None:
+        if trace and trace != "1":
+            profile_cal2.profiler.write_trace(trace)
+        else:
+            profile_cal2.profiler.report(sys.stderr)
 
 
 if __name__ == '__main__':
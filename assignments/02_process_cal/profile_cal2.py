@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pipeline profiling for process_cal2 (see --profile).
+
+process_cal2.main sets profiler to a Profiler when profiling is on; the pipeline wraps each stage in
+"with stage(name) as record:", which does nothing while profiler is None.
+"""
+import os
+import time
+import contextlib
+from typing import Iterator, TextIO
+
+PROFILE_ENV = "PROCESS_CAL2_PROFILE"
+
+
+class Profiler:
+    """ Records wall time, peak traced memory and record counts for each pipeline stage (see --profile).
+    """
+
+    def __init__(self) -> None:
+        import tracemalloc
+
+        self.stages = []
+        self.origin = time.perf_counter_ns()
+        tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[dict]:
+        """ Measures the body of a with block as one stage; the body may set record["count"].
+                Input: stage name
+                Output: the stage's record dict
+        """
+        import tracemalloc
+
+        record = {"name": name, "count": None}
+        tracemalloc.reset_peak()
+        began = time.perf_counter_ns()
+        try:
+            yield record
+        finally:
+            record["start_ns"] = began - self.origin
+            record["wall_ns"] = time.perf_counter_ns() - began
+            record["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            self.stages.append(record)
+
+    def report(self, file: TextIO) -> None:
+        """ Writes a human-readable summary table.
+                Input: writable text file
+        """
+        file.write(f'{"stage":<16}{"wall ms":>12}{"peak MiB":>12}{"records":>12}\n')
+        for record in self.stages:
+            count = "" if record["count"] is None else record["count"]
+            file.write(f'{record["name"]:<16}{record["wall_ns"] / 1e6:>12.3f}'
+                       f'{record["peak_bytes"] / 2**20:>12.3f}{count:>12}\n')
+
+    def write_trace(self, filename: str) -> None:
+        """ Writes the stages as a Chrome trace (chrome://tracing, Perfetto) JSON file.
+                Input: output filename
+        """
+        import json
+
+        events = [{"name": record["name"], "ph": "X", "pid": os.getpid(), "tid": 0,
+                   "ts": record["start_ns"] / 1000, "dur": record["wall_ns"] / 1000,
+                   "args": {"count": record["count"], "peak_bytes": record["peak_bytes"]}}
+                  for record in self.stages]
+        with open(filename, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+
+class NullStage:
+    """ Stand-in for Profiler.stage when profiling is off; entering and leaving it does no work.
+    """
+
+    def __init__(self) -> None:
+        self.record = {}
+
+    def __enter__(self) -> dict:
+        return self.record
+
+    def __exit__(self, *exc) -> None:
+        return None
+
+
+NULL_STAGE = NullStage()
+profiler = None
+
+
+def stage(name: str):
+    """ Starts a profiled stage, or a no-op one when profiling is disabled.
+            Input: stage name
+            Output: context manager yielding the stage's record dict
+    """
+    if profiler is None:
+        return NULL_STAGE
+    return profiler.stage(name)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Resident query service for process_cal2.
+
+Loads the events, circuits and broadcasters once, keeps the sorted EventIndex in memory and answers
+date window queries over HTTP (TCP or a unix socket) with the same YAML that write_file produces:
+
+    GET /?start=2022/1/1&end=2022/12/31[&overlap=1]
+
+The input files are polled for changes; only the files that changed are re-parsed before the index is
+rebuilt, and queries keep being answered from the previous index while that happens.
+
+Usage:
+    python3 process_cal2.py --serve=127.0.0.1:8265 --events=... --circuits=... --broadcasters=...
+    python3 process_cal2.py --serve=unix:/tmp/cal2.sock --events=... --circuits=... --broadcasters=...
+"""
+import io
+import os
+import sys
+import asyncio
+import urllib.parse
+from typing import Dict, List, Optional, Tuple
+
+import core_cal2
+
+POLL_INTERVAL = 1.0
+MAX_HEADER_BYTES = 64 * 1024
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+
+
+class Calendar:
+    """ The parsed inputs and the index built from them, reloadable one file at a time.
+    """
+
+    def __init__(self, event_spec: str, circuit_filename: str, broadcaster_filename: str,
+                 cache: Optional[str] = None) -> None:
+        """ Input: events specification (see core_cal2.expand_filenames), circuits and broadcasters
+                   filenames, cache directory (see core_cal2.parse_files)
+        """
+        self.event_spec = event_spec
+        self.circuit_filename = circuit_filename
+        self.broadcaster_filename = broadcaster_filename
+        self.cache = cache
+        self.versions = {}
+        self.streams = {}
+        self.state = None  # (EventIndex, circuit index, broadcaster index), swapped as a whole
+        self.reload()
+
+    def reload(self) -> List[str]:
+        """ Re-parses the files whose mtime or size changed (or that newly match the events globs) and
+            rebuilds the index. The new state replaces the old one only once it is fully built and valid.
+                Output: list of filenames that were re-parsed
+        """
+        filenames = core_cal2.expand_filenames(self.event_spec)
+        versions = {filename: file_version(filename)
+                    for filename in filenames + [self.circuit_filename, self.broadcaster_filename]}
+        changed = [filename for filename, version in versions.items() if self.versions.get(filename) != version]
+        if not changed and self.state is not None:
+            return []
+
+        streams = {filename: self.streams[filename] if filename not in changed
+                   else core_cal2.load_cached(filename, core_cal2.parse_events, self.cache)
+                   for filename in filenames}
+        _, circuits, broadcasters = self.state or (None, {}, {})
+        if self.circuit_filename in changed:
+            circuits = core_cal2.build_index(
+                core_cal2.load_cached(self.circuit_filename, core_cal2.parse_file, self.cache), "circuit")
+        if self.broadcaster_filename in changed:
+            broadcasters = core_cal2.build_index(
+                core_cal2.load_cached(self.broadcaster_filename, core_cal2.parse_file, self.cache),
+                "broadcaster")
+
+        events = core_cal2.merge_events(filenames, [streams[filename] for filename in filenames])
+        core_cal2.validate_references(events, circuits, broadcasters)
+        index = core_cal2.EventIndex(events)
+
+        self.versions, self.streams = versions, streams
+        self.state = (index, circuits, broadcasters)
+        return changed
+
+    def query(self, start: str, end: str, overlap: bool = False) -> str:
+        """ Renders one date window as YAML.
+                Input: start and end "yyyy/mm/dd" strings, whether to include overlapping events
+                Output: YAML text, identical to the output.yaml process_cal2 would write
+        """
+        index, circuits, broadcasters = self.state
+        output = io.StringIO()
+        core_cal2.render_window(index, circuits, broadcasters, core_cal2.parse_date(start),
+                                   core_cal2.parse_date(end), output, overlap, workers=1)
+        return output.getvalue()
+
+
+def file_version(filename: str) -> Tuple[int, int]:
+    """ Identifies the current version of a file for change detection.
+            Input: filename string
+            Output: (mtime in ns, size in bytes)
+    """
+    stat = os.stat(filename)
+    return stat.st_mtime_ns, stat.st_size
+
+
+async def watch(calendar: Calendar, interval: float) -> None:
+    """ Polls the input files and reloads the changed ones in a worker thread.
+            Input: Calendar, polling interval in seconds
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            changed = await loop.run_in_executor(None, calendar.reload)
+        except (OSError, ValueError, KeyError) as error:
+            log(f"reload failed, still serving the previous data: {error!r}")
+            continue
+        if changed:
+            log("reloaded " + ", ".join(changed))
+
+
+async def handle(calendar: Calendar, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """ Answers one HTTP request. The query is rendered in a worker thread, as in watch, so a large window
+        does not stall other connections or reloads; calendar.state is swapped in one assignment, so a query
+        always sees a consistent snapshot.
+            Input: Calendar, connection streams
+    """
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        writer.close()
+        return
+
+    loop = asyncio.get_running_loop()
+    status, body = await loop.run_in_executor(None, respond, calendar, head.decode("latin-1").split("\r\n", 1)[0])
+    data = body.encode()
+    writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                 f"Content-Type: {'application/yaml' if status == 200 else 'text/plain'}; charset=utf-8\r\n"
+                 f"Content-Length: {len(data)}\r\n"
+                 "Connection: close\r\n\r\n".encode() + data)
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+def respond(calendar: Calendar, request_line: str) -> Tuple[int, str]:
+    """ Maps a request line to a status code and response body.
+            Input: Calendar, HTTP request line, e.g. "GET /?start=2022/1/1&end=2022/2/1 HTTP/1.1"
+            Output: (status code, body text)
+    """
+    parts = request_line.split()
+    if len(parts) != 3:
+        return 400, "malformed request line\n"
+    method, target, _ = parts
+    if method != "GET":
+        return 405, "only GET is supported\n"
+
+    url = urllib.parse.urlsplit(target)
+    if url.path != "/":
+        return 404, "not found\n"
+    params = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+    try:
+        return 200, calendar.query(params["start"][0], params["end"][0], "overlap" in params)
+    except (KeyError, ValueError):
+        return 400, "expected ?start=yyyy/mm/dd&end=yyyy/mm/dd\n"
+
+
+async def run(calendar: Calendar, address: str, interval: float) -> None:
+    """ Serves queries forever.
+            Input: Calendar, "host:port" or "unix:/path/to/socket", polling interval in seconds
+    """
+    def connected(reader, writer):
+        return handle(calendar, reader, writer)
+
+    if address.startswith("unix:"):
+        server = await asyncio.start_unix_server(connected, address[len("unix:"):], limit=MAX_HEADER_BYTES)
+    else:
+        host, _, port = address.rpartition(":")
+        server = await asyncio.start_server(connected, host or "127.0.0.1", int(port), limit=MAX_HEADER_BYTES)
+
+    log(f"serving {len(calendar.state[0].events)} events on {address}")
+    async with server:
+        await asyncio.gather(server.serve_forever(), watch(calendar, interval))
+
+
+def serve(options: Dict[str, str]) -> None:
+    """ Entry point for process_cal2 --serve.
+            Input: parsed command line options (see core_cal2.parse_options)
+    """
+    calendar = Calendar(options["events"], options["circuits"], options["broadcasters"], options.get("cache"))
+    interval = float(options.get("interval") or POLL_INTERVAL)
+    try:
+        asyncio.run(run(calendar, options["serve"] or "127.0.0.1:8265", interval))
+    except KeyboardInterrupt:
+        pass
+
+
+def log(message: str) -> None:
+    """ Prints a status message on stderr.
+    """
+    print("[serve_cal2]:", message, file=sys.stderr, flush=True)
+
+
+if __name__ == '__main__':
+    serve(core_cal2.parse_options(sys.argv[1:]))
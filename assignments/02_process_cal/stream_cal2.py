@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming single queries for process_cal2.
+
+A query over XML events runs as a pipeline of generators, from the parser through the window filter, a sort that
+keeps at most a memory cap of events in memory (spilling sorted runs to temporary files past it) and the reference
+checks into the YAML writer, so the calendar is never held in memory as a whole (see stream_query).
+"""
+import os
+import sys
+import heapq
+import array
+import struct
+import functools
+import itertools
+import datetime
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import profile_cal2
+from profile_cal2 import stage
+from core_cal2 import (Event, build_index, expand_filenames, get_date, iter_events, iter_events_mmap, load_cached,
+                       parse_file, parse_utc_offset, to_minutes, validate_references, write_file)
+from columnar_cal2 import ColumnarIndex, is_columnar
+
+SORT_MEMORY_EVENTS = 500000
+SPILL_BATCH = 4096
+MERGE_FAN_IN = 64
+RUN_BATCH = struct.Struct("<III")
+
+
+def stream_window(filenames: List[str],
+                  start: datetime.datetime,
+                  end: datetime.datetime,
+                  overlap: bool = False,
+                  presorted: bool = False,
+                  memory_cap: int = SORT_MEMORY_EVENTS,
+                  use_mmap: bool = False) -> Iterable[Event]:
+    """ Yields the events of a date window in start order, straight from the parser: presorted files are
+        checked as they stream, others are sorted by sort_event_file, in worker processes when there are several.
+            Input: list of events filenames, start and end datetimes, whether to include overlapping events,
+                   whether the files are sorted by start, event memory cap, whether to scan through mmap
+            Output: Events sorted by start (a list if a single file was sorted in memory);
+                    ties keep file order, then order within a file
+    """
+    window = (to_minutes(start), to_minutes(end))
+    share = max(1, memory_cap // len(filenames))
+
+    if presorted:
+        streams = [check_sorted(window_filter(iter_event_file(filename, window, use_mmap), window, overlap),
+                                filename)
+                   for filename in filenames]
+    elif len(filenames) == 1:
+        return sort_events(window_filter(iter_event_file(filenames[0], window, use_mmap), window, overlap), share)
+    else:
+        sort_file = functools.partial(sort_event_file, window=window, overlap=overlap, memory_cap=share,
+                                      use_mmap=use_mmap)
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(min(len(filenames), os.cpu_count() or 1)) as pool:
+            results = list(pool.map(sort_file, filenames))
+        streams = [result if isinstance(result, list) else read_run(open_run(result)) for result in results]
+
+    owners = {}
+    streams = [check_unique(events, filenames, i, owners) for i, events in enumerate(streams)]
+    return heapq.merge(*streams, key=get_date)
+
+
+def sort_event_file(filename: str,
+                    window: Tuple[int, int],
+                    overlap: bool,
+                    memory_cap: int,
+                    use_mmap: bool) -> Union[List[Event], str]:
+    """ Parses, filters and sorts one events file inside a worker process (see stream_window).
+        A file whose window holds more than memory_cap events comes back as a spilled run file instead of a list.
+            Input: filename string, (start, end) minute ordinals, whether to include overlapping events,
+                   event memory cap, whether to scan through mmap
+            Output: list of Events sorted by start, or the name of a run file (see write_run) holding them
+    """
+    import tempfile
+
+    events = sort_events(window_filter(iter_event_file(filename, window, use_mmap), window, overlap), memory_cap)
+    if isinstance(events, list):
+        return events
+    with tempfile.NamedTemporaryFile("wb", prefix="cal2run-", delete=False) as run:
+        write_run(events, run)
+    return run.name
+
+
+def open_run(filename: str) -> BinaryIO:
+    """ Opens a run file handed over by sort_event_file and unlinks it, so it goes away once closed.
+            Input: run filename
+            Output: binary file object
+    """
+    run = open(filename, "rb")
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+    return run
+
+
+def iter_event_file(filename: str, window: Optional[Tuple[int, int]], use_mmap: bool) -> Iterator[Event]:
+    """ Opens an events file and streams its Events (see iter_events and iter_events_mmap).
+            Input: filename string, optional (start, end) minute ordinals, whether to scan through mmap
+            Output: generator of Events in file order
+    """
+    if use_mmap:
+        yield from iter_events_mmap(filename, window)
+    else:
+        with open(filename, "rb") as file:
+            yield from iter_events(file, window)
+
+
+def check_unique(events: Iterable[Event], filenames: List[str], i: int, owners: Dict[str, int]) -> Iterator[Event]:
+    """ Passes events through, failing on an id already seen in another file. The shared dict keeps one entry
+        per in-window event id, so this check is the one part of a multi-file stream that memory_cap does not
+        bound (see stream_window).
+            Input: Events of filenames[i], all filenames, id to file number dict shared by all the files
+            Output: generator of the same Events
+    """
+    for event in events:
+        owner = owners.setdefault(event.id, i)
+        if owner != i:
+            raise ValueError(f"duplicate event id {event.id} in {filenames[owner]} and {filenames[i]}")
+        yield event
+
+
+def window_filter(events: Iterable[Event], window: Tuple[int, int], overlap: bool = False) -> Iterator[Event]:
+    """ Lazy version of EventIndex.range's test (or of EventIndex.overlapping's when overlap is set).
+            Input: Events, (start, end) minute ordinals, whether to include overlapping events
+            Output: generator of the matching Events, in the same order
+    """
+    start, end = window
+    for event in events:
+        if event.start < end and (start < event.start or (overlap and start < event.end)):
+            yield event
+
+
+def check_sorted(events: Iterable[Event], filename: str) -> Iterator[Event]:
+    """ Passes events through, failing as soon as one starts before its predecessor.
+            Input: Events, filename for the error message
+            Output: generator of the same Events
+    """
+    last = None
+    for event in events:
+        if last is not None and event.start < last:
+            raise ValueError(f"{filename} is not sorted by start time (event {event.id}); drop --presorted")
+        last = event.start
+        yield event
+
+
+def sort_events(events: Iterable[Event], memory_cap: int = SORT_MEMORY_EVENTS) -> Iterable[Event]:
+    """ Stable sort by start that keeps at most memory_cap events in memory. Below that it is a plain list sort;
+        once that many are buffered, they are sorted and spilled to a temporary file as one run (see spill_run),
+        and the runs are merged with a heap, earlier runs first on ties, so the order is exactly that of
+        sorted(events, key=get_date) either way. At most MERGE_FAN_IN runs are kept open (see merge_spilled).
+            Input: Events, maximum number of events to buffer
+            Output: list of Events sorted by start, or a generator of them if anything was spilled
+    """
+    runs = []
+    buffer = []
+
+    try:
+        for event in events:
+            buffer.append(event)
+            if len(buffer) >= memory_cap:
+                buffer.sort(key=get_date)
+                runs.append(spill_run(buffer))
+                buffer = []
+                if len(runs) >= MERGE_FAN_IN:
+                    runs = [merge_spilled(runs)]
+    except BaseException:
+        for run in runs:
+            run.close()
+        raise
+
+    buffer.sort(key=get_date)
+    if not runs:
+        return buffer
+    return merge_runs(runs, buffer)
+
+
+def merge_runs(runs: List[BinaryIO], last: List[Event]) -> Iterator[Event]:
+    """ Heap-merges spilled runs and the final in-memory run, closing (and so deleting) the run files.
+            Input: run files from spill_run in spill order, last sorted list of Events
+            Output: generator of Events sorted by start
+    """
+    try:
+        yield from heapq.merge(*[read_run(run) for run in runs], last, key=get_date)
+    finally:
+        for run in runs:
+            run.close()
+
+
+def merge_spilled(runs: List[BinaryIO]) -> BinaryIO:
+    """ Merges spilled runs into one larger run, closing (and so deleting) them.
+            Input: run files from spill_run in spill order
+            Output: the merged run file, rewound
+    """
+    import tempfile
+
+    merged = tempfile.TemporaryFile()
+    try:
+        write_run(heapq.merge(*[read_run(run) for run in runs], key=get_date), merged)
+    except BaseException:
+        merged.close()
+        raise
+    finally:
+        for run in runs:
+            run.close()
+    merged.seek(0)
+    return merged
+
+
+def spill_run(events: List[Event]) -> BinaryIO:
+    """ Writes a sorted run of events to an anonymous temporary file (see write_run).
+            Input: sorted list of Events
+            Output: the temporary file, rewound
+    """
+    import tempfile
+
+    run = tempfile.TemporaryFile()
+    write_run(events, run)
+    run.seek(0)
+    return run
+
+
+def write_run(events: Iterable[Event], run: BinaryIO) -> None:
+    """ Writes sorted events in batches of SPILL_BATCH events.
+        Each batch is a RUN_BATCH header (event count, string count, string table size), its distinct strings
+        NUL-separated (NUL cannot occur in XML text), then one array of 4 string numbers per event and one
+        array of start and end minute ordinals. Descriptions, locations and broadcasters repeat heavily,
+        so this is a fraction of the size of pickled Events.
+            Input: sorted Events, binary file to append to
+    """
+    events = iter(events)
+    while True:
+        batch = list(itertools.islice(events, SPILL_BATCH))
+        if not batch:
+            return
+        numbers = {}
+        refs = array.array("I")
+        times = array.array("q")
+        for event in batch:
+            for value in (event.id, event.description, event.location, event.broadcaster):
+                refs.append(numbers.setdefault(value, len(numbers)))
+            times.append(event.start)
+            times.append(event.end)
+        table = "\0".join(numbers).encode()
+        run.write(RUN_BATCH.pack(len(batch), len(numbers), len(table)))
+        run.write(table)
+        run.write(refs.tobytes())
+        run.write(times.tobytes())
+
+
+def read_run(run: BinaryIO) -> Iterator[Event]:
+    """ Streams a spilled run back one batch at a time, closing the file at the end.
+            Input: binary file written by write_run, positioned at its start
+            Output: generator of Events
+    """
+    with run:
+        yield from read_batches(run)
+
+
+def read_batches(run: BinaryIO) -> Iterator[Event]:
+    """ Decodes the batches of a run file (see write_run).
+            Input: binary file positioned at a batch
+            Output: generator of Events
+    """
+    while True:
+        header = run.read(RUN_BATCH.size)
+        if not header:
+            return
+        count, _, size = RUN_BATCH.unpack(header)
+        strings = run.read(size).decode().split("\0")
+        refs = array.array("I")
+        refs.frombytes(run.read(4 * count * refs.itemsize))
+        times = array.array("q")
+        times.frombytes(run.read(2 * count * times.itemsize))
+        for i in range(count):
+            yield Event(strings[refs[4 * i]], strings[refs[4 * i + 1]], strings[refs[4 * i + 2]],
+                        strings[refs[4 * i + 3]], times[2 * i], times[2 * i + 1])
+
+
+def count_events(events: Iterable[Event], record: dict) -> Iterator[Event]:
+    """ Passes events through, counting them into a profiled stage's record (see stage).
+            Input: Events, stage record dict
+            Output: generator of the same Events
+    """
+    record["count"] = 0
+    for event in events:
+        record["count"] += 1
+        yield event
+
+
+def check_references(events: Iterable[Event],
+                     circuits: Dict[str, dict],
+                     broadcasters: Dict[str, dict]) -> Iterator[Event]:
+    """ Lazy version of validate_references: fails on the first event with a dangling reference.
+            Input: Events, circuit index, broadcaster index
+            Output: generator of the same Events
+    """
+    checked = set()
+    for event in events:
+        if event.location not in checked or event.broadcaster not in checked:
+            validate_references([event], circuits, broadcasters)
+            checked.update((event.location, event.broadcaster))
+        yield event
+
+
+
+def to_timezone(events: Iterable[Event],
+                circuits: Dict[str, dict],
+                timezone: str,
+                memory_cap: int = SORT_MEMORY_EVENTS) -> Tuple[Iterable[Event], Dict[str, dict]]:
+    """ Moves events from their circuits' local time into a viewer's timezone. Events of circuits in different
+        timezones can change order and day, so the moved events are sorted again (see sort_events), and the
+        circuits are copied with the viewer's timezone as the one to print.
+            Input: sorted Events with valid locations, circuit index, viewer timezone (see parse_utc_offset),
+                   event memory cap for the sort
+            Output: Events sorted by start in the viewer's timezone, circuit index to render them with
+    """
+    target = parse_utc_offset(timezone)
+    shifts = {id: target - parse_utc_offset(circuit["timezone"]) for id, circuit in circuits.items()}
+    moved = (Event(event.id, event.description, event.location, event.broadcaster,
+                   event.start + shifts[event.location], event.end + shifts[event.location])
+             for event in events)
+    labelled = {id: dict(circuit, timezone=timezone) for id, circuit in circuits.items()}
+    return sort_events(moved, memory_cap), labelled
+
+
+def stream_query(options: Dict[str, str], start: datetime.datetime, end: datetime.datetime) -> None:
+    """ Answers a single query without materializing the calendar, streaming events from the parser through
+        the window filter, the bounded sort (see sort_events) and the reference checks into the YAML writer.
+            Input: parsed command line options, query window
+    """
+    overlap = "overlap" in options
+    memory_cap = int(options.get("memory-cap") or SORT_MEMORY_EVENTS)
+    if memory_cap < 1:
+        sys.exit(f"{sys.argv[0]}: --memory-cap must be at least 1")
+
+    if is_columnar(options["events"]):
+        with stage("open") as record:
+            index = ColumnarIndex(options["events"])
+            circuits, broadcasters = index.circuits, index.broadcasters
+            events = index.iter_window(start, end, overlap)
+            record["count"] = len(index)
+    else:
+        with stage("parse") as record:
+            events = stream_window(expand_filenames(options["events"]), start, end, overlap,
+                                   "presorted" in options, memory_cap, "mmap" in options)
+            circuits = load_cached(options["circuits"], parse_file, options.get("cache"))
+            broadcasters = load_cached(options["broadcasters"], parse_file, options.get("cache"))
+            if isinstance(events, list):
+                record["count"] = len(events)
+        with stage("references") as record:
+            circuits = build_index(circuits, "circuit")
+            broadcasters = build_index(broadcasters, "broadcaster")
+            if isinstance(events, list):
+                validate_references(events, circuits, broadcasters)
+            else:
+                events = check_references(events, circuits, broadcasters)
+            record["count"] = len(circuits) + len(broadcasters)
+
+    if options.get("timezone"):
+        with stage("timezone") as record:
+            events, circuits = to_timezone(events, circuits, options["timezone"], memory_cap)
+            if isinstance(events, list):
+                record["count"] = len(events)
+
+    with stage("write") as record:
+        if isinstance(events, list):
+            record["count"] = len(events)
+        elif profile_cal2.profiler is not None:
+            events = count_events(events, record)
+        workers = int(options["workers"]) if options.get("workers") else None
+        write_file(events, circuits, broadcasters, options.get("output") or "./output.yaml", workers)
+
@@ -6,9 +6,36 @@ Created on Tue Feb 01 07:35:33 2022
 
 This tester file allows to validate the correctness of the produced output.yaml files
 """
+import os
 import sys
+import hashlib
+import itertools
 import yaml
-from deepdiff import DeepDiff
+
+# the runtime and peak RSS checks and the expected-output manifest are shared with the other assignments' testers
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import perf_gate
+import fingerprint_manifest
+
+# the libyaml-backed loader when PyYAML was built with it, several times faster than the pure Python one
+LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+# the commands of TESTS.md, run by --run
+TESTS = {
+    'test01.yaml': 'python3 process_cal2.py --start=2022/12/1 --end=2022/12/30 --events=2022-season-testing.xml '
+                   '--circuits=circuits.xml --broadcasters=broadcasters.xml',
+    'test02.yaml': 'python3 process_cal2.py --start=2022/2/25 --end=2022/3/15 --events=2022-season-testing.xml '
+                   '--circuits=circuits.xml --broadcasters=broadcasters.xml',
+    'test03.yaml': 'python3 process_cal2.py --start=2022/2/1 --end=2022/3/9 --events=2022-season-testing.xml '
+                   '--circuits=circuits.xml --broadcasters=broadcasters.xml',
+    'test04.yaml': 'python3 process_cal2.py --start=2022/2/1 --end=2022/7/1 --events=2022-f1-races-americas.xml '
+                   '--circuits=circuits.xml --broadcasters=broadcasters.xml',
+    'test05.yaml': 'python3 process_cal2.py --start=2022/1/1 --end=2022/12/31 --events=2022-f1-races-americas.xml '
+                   '--circuits=circuits.xml --broadcasters=broadcasters.xml',
+    'test06.yaml': 'python3 process_cal2.py --start=2022/1/1 --end=2022/12/31 --events=2022-f1-races-americas.xml '
+                   '--circuits=circuits.xml --broadcasters=broadcasters.xml --timezone=UTC+9',
+    'test07.yaml': 'python3 process_cal2.py --start=2022/11/14 --end=2022/11/30 --events=2022-midnight-replays.xml '
+                   '--circuits=circuits.xml --broadcasters=broadcasters.xml --overlap',
+}
 
 
 def print_message(message):
@@ -38,7 +65,123 @@ def read_yaml_data(file):
         If the .yaml file contains errors
     """
     with open(file, 'r') as stream:
-        return yaml.safe_load(stream)
+        return yaml.load(stream, Loader=LOADER)
+
+
+def read_day_groups(stream):
+    """Splits an output.yaml file into the text of its day groups (the items of the events list), without
+    parsing them.
+
+    Parameters
+    ----------
+    stream : file, required
+        The open file to read.
+
+    Raises
+    ------
+    ValueError
+        If the file is not laid out as an events: list of day groups.
+
+    Returns
+    -------
+    groups
+        A generator of strings, one per day group.
+    """
+    lines = (line for line in stream if line.strip() and not line.lstrip().startswith('#'))
+    header = next(lines, None)
+    if header is None or header.rstrip() != 'events:':
+        raise ValueError('unexpected header ' + repr(header))
+    indent = None
+    group = []
+    for line in lines:
+        width = len(line) - len(line.lstrip(' '))
+        if indent is None:
+            indent = width
+        if width < indent or (width == indent and not line.lstrip(' ').startswith('- ')):
+            raise ValueError('unexpected line ' + repr(line))
+        if width == indent and group:
+            yield ''.join(group)
+            group = []
+        group.append(line)
+    if group:
+        yield ''.join(group)
+
+
+def fingerprint_group(group):
+    """Hashes the normalized text of a day group (trailing spaces dropped).
+
+    Parameters
+    ----------
+    group : str, required
+        The text of the day group (see read_day_groups).
+
+    Returns
+    -------
+    digest
+        The hex digest of the group.
+    """
+    normalized = ''.join(line.rstrip() + '\n' for line in group.splitlines())
+    return hashlib.blake2b(normalized.encode(), digest_size=16).hexdigest()
+
+
+def fingerprint_file(file):
+    """Hashes an output.yaml file per day group, reading it once.
+
+    Parameters
+    ----------
+    file : str, required
+        The file path of the file to hash.
+
+    Raises
+    ------
+    ValueError
+        If the file is not laid out as an events: list of day groups.
+
+    Returns
+    -------
+    fingerprint
+        A dict with the hash of the whole file and the list of hashes of its day groups.
+    """
+    with open(file, 'r') as stream:
+        groups = [fingerprint_group(group) for group in read_day_groups(stream)]
+    whole = hashlib.blake2b(''.join(groups).encode(), digest_size=16).hexdigest()
+    return {'hash': whole, 'groups': groups}
+
+
+def find_first_difference(given_file, expected_file, start=0):
+    """Compares two output.yaml files one day group at a time, stopping at the first group that differs.
+    Groups with identical text are not parsed at all.
+
+    Parameters
+    ----------
+    given_file : str, required
+        The file path of the given file (output.yaml)
+    expected_file : str, required
+        The file path of the expected output file (e.g., test01.yaml)
+    start : int, optional
+        The number of leading day groups already known to be equal, which are skipped without comparing them.
+
+    Raises
+    ------
+    ValueError
+        If a file is not laid out as an events: list of day groups.
+
+    Returns
+    -------
+    difference
+        None if the files are equal, else (index, given groups, expected groups) for the first differing day
+        group, each side being the parsed list holding that group ([] when the file has no such group).
+    """
+    with open(given_file, 'r') as given_stream, open(expected_file, 'r') as expected_stream:
+        pairs = itertools.zip_longest(read_day_groups(given_stream), read_day_groups(expected_stream))
+        for index, (given, expected) in enumerate(itertools.islice(pairs, start, None), start):
+            if given == expected:
+                continue
+            given_data = yaml.load(given, Loader=LOADER) if given is not None else []
+            expected_data = yaml.load(expected, Loader=LOADER) if expected is not None else []
+            if given_data != expected_data:
+                return index, given_data, expected_data
+    return None
 
 
 def compare_file_content(given_file_data, expected_data):
@@ -51,39 +194,118 @@ def compare_file_content(given_file_data, expected_data):
     expected_data : dic, required
         A dictionary with the data from expected output file (e.g., test01.yaml)
     """
+    # only needed to explain failures, and slow to import
+    from deepdiff import DeepDiff
     return DeepDiff(expected_data, given_file_data, ignore_order=False)
 
 
+def compare_files(given_file, expected_file):
+    """Compares two output.yaml files. When they have the usual layout, the given file is only hashed and
+    checked against the expected file's fingerprint (see fingerprint_manifest); if that differs, the files are
+    streamed one day group at a time from the first group whose hash differs. Other files are loaded whole.
+
+    Parameters
+    ----------
+    given_file : str, required
+        The file path of the given file (output.yaml)
+    expected_file : str, required
+        The file path of the expected output file (e.g., test01.yaml)
+
+    Returns
+    -------
+    result
+        An empty dict if the files are equal, else the DeepDiff report of the first differing day group
+        (its paths are the same as for the whole files), or of the whole files if they could not be streamed.
+    """
+    try:
+        produced = fingerprint_file(given_file)
+        golden = fingerprint_manifest.expected_fingerprint(expected_file, fingerprint_file)
+        if produced['hash'] == golden['hash']:
+            return {}
+        pairs = zip(produced['groups'], golden['groups'])
+        start = next((index for index, (given, expected) in enumerate(pairs) if given != expected),
+                     min(len(produced['groups']), len(golden['groups'])))
+        difference = find_first_difference(given_file, expected_file, start)
+    except ValueError:
+        given_file_data = read_yaml_data(given_file)
+        expected_data = read_yaml_data(expected_file)
+        if given_file_data == expected_data:
+            return {}
+        return compare_file_content(given_file_data, expected_data)
+    if difference is None:
+        return {}
+    # pad both sides with the same placeholders for the equal groups, so the report points at the right index
+    index, given_data, expected_data = difference
+    return compare_file_content({'events': [None] * index + given_data}, {'events': [None] * index + expected_data})
+
+
 def main():
     """The main entry point for the program.
 
     It requires the input file to be named as output.yaml and a file that contains the expected output for the test
-    (e.g., test01.yaml) as an argument for the program
+    (e.g., test01.yaml) as an argument for the program. With --full, both files are loaded whole and every
+    difference is reported instead of those of the first differing day group.
+
+    With --run, the test's command (see TESTS) is run first, and its runtime and peak RSS are checked against the
+    stored baseline: the test fails if either exceeds it by more than --perf-tolerance=F (PERF_TOLERANCE by
+    default, see perf_gate). --perf-record stores them as the new baseline instead, if the test passes.
+
+    Returns 0 if the test passed, 1 otherwise (the exit status of the tester).
     """
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith('--')]
+    options = [argument for argument in sys.argv[1:] if argument.startswith('--')]
+    tolerance = perf_gate.parse_tolerance(options)
     # Validate arguments
-    if not len(sys.argv) == 2:
-        print_message('Usage: ' + sys.argv[0] + ' <expected-output-yaml>')
+    if not len(arguments) == 1:
+        print_message('Usage: ' + sys.argv[0] + ' [--full] [--run [--perf-record] [--perf-tolerance=F]]'
+                      + ' <expected-output-yaml>')
+        return 1
+    elif '--run' in options and os.path.basename(arguments[0]) not in TESTS:
+        print_message('ERROR: no command is known for ' + arguments[0])
+        return 1
     else:
         # Get the arguments for the app
         given_output_file_path = 'output.yaml'
-        expected_output_file_path = sys.argv[1]
+        expected_output_file_path = arguments[0]
+        perf = None
+        if '--run' in options:
+            command = TESTS[os.path.basename(expected_output_file_path)]
+            returncode, seconds, peak_rss_kb = perf_gate.run_measured(command)
+            print_message('Ran "' + command + '" (' + format(seconds, '.3f') + 's, ' + str(peak_rss_kb) + ' KB)')
+            if returncode != 0:
+                print_message('TEST FAILED. The command exited with status ' + str(returncode) + '.')
+                return 1
+            baseline = perf_gate.read_baseline()
+            if command in baseline and '--perf-record' not in options:
+                perf = perf_gate.check_performance(seconds, peak_rss_kb, baseline[command], tolerance)
         try:
-            # Obtain the yaml data
-            given_file_data = read_yaml_data(given_output_file_path)
-            expected_data = read_yaml_data(expected_output_file_path)
             # Obtain the differences
-            result = compare_file_content(given_file_data, expected_data)
+            if '--full' in sys.argv:
+                result = compare_file_content(read_yaml_data(given_output_file_path),
+                                              read_yaml_data(expected_output_file_path))
+            else:
+                result = compare_files(given_output_file_path, expected_output_file_path)
             if len(result) > 0:
                 print_message('TEST FAILED.' + ' Differences are shown below:')
                 print(result)
+                return 1
+            elif perf is not None:
+                print_message('TEST FAILED. Performance regression: ' + perf)
+                return 1
             else:
                 print_message('TEST PASSED')
+                if '--run' in options and '--perf-record' in options:
+                    baseline[command] = {'seconds': seconds, 'peak_rss_kb': peak_rss_kb}
+                    perf_gate.write_baseline(baseline)
+                    print_message('Performance baseline written to ' + perf_gate.PERF_BASELINE)
+                return 0
         except FileNotFoundError as fnf:
             print(print_message('ERROR: ' + fnf.strerror))
         except yaml.scanner.ScannerError as sce:
             print(print_message('ERROR: ' + 'A provided .yaml file contains syntax errors (i.e., invalid YAML file): '
                                 + str(sce)))
+        return 1
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
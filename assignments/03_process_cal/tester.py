@@ -8,11 +8,26 @@ This tester file allows to validate the correctness of the process_cal3 program
 """
 import sys
 import os
+import time
+import difflib
+import hashlib
+import itertools
+import tempfile
+import concurrent.futures
 from pathlib import Path
 
+# the runtime and peak RSS checks and the expected-output manifest are shared with the other assignments' testers
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import perf_gate
+import fingerprint_manifest
 
-def run_one(command, expected_file_path, show_diffs):
+QUIET_MAX_DIFFS = 1
+
+
+def run_one(command, expected_file_path, show_diffs, aligned=False, perf=False, record=False,
+            tolerance=perf_gate.PERF_TOLERANCE):
     """Allows to run one test and compare its output against the expect one.
+    The produced output is left in output.txt for inspection.
 
     Parameters
     ----------
@@ -22,77 +37,249 @@ def run_one(command, expected_file_path, show_diffs):
         The path of the file that contains the expected output for the test.
     show_diffs: bool, required
         Indicates whether to show or not the list of differences found during the test.
+    aligned: bool, optional
+        Indicates whether to align the outputs before listing differences (see aligned_diffs).
+    perf : bool, optional
+        Indicates whether to check the runtime and peak RSS against the stored baseline.
+    record : bool, optional
+        Indicates whether to store the runtime and peak RSS as the new baseline instead of checking them.
+    tolerance : float, optional
+        The fraction by which runtime and peak RSS may exceed the baseline (see perf_gate.check_performance).
+
+    Returns
+    -------
+    passed
+        Whether the test passed.
     """
-    result = True
-    file_to_generate = 'output.txt'
-    original_command = command
-    command = command + ' > ' + file_to_generate
+    baseline = perf_gate.read_baseline() if perf or record else {}
     print_message(is_error=False, message='Attempting "' + command + '" and expecting ' + expected_file_path + '...')
-    # running the command
-    os.system(command)
-    # validating execution
-    if not os.path.isfile(file_to_generate):
-        print_message(is_error=True, message=original_command + ' FAILED. See details above.')
-    else:
-        # compare lines
-        print_message(is_error=False, message='Comparing lines...')
+    with open('output.txt', 'w+') as output:
+        case = run_case(command, expected_file_path, output=output,
+                        max_diffs=None if show_diffs else QUIET_MAX_DIFFS, aligned=aligned)
+    apply_baseline(case, baseline, record, tolerance)
+    print_case(case, show_diffs)
+    if record:
+        perf_gate.write_baseline(baseline)
+        print_message(is_error=False, message='Performance baseline written to ' + perf_gate.PERF_BASELINE + '.')
+    return case['passed']
+
+
+def run_case(command, expected_file_path, output=None, max_diffs=QUIET_MAX_DIFFS, aligned=False):
+    """Allows to run one test in isolation: its output goes to its own file (a temporary one by default),
+    so several tests can run at the same time, and is compared as a stream.
+
+    Parameters
+    ----------
+    command : str, required
+        The command to run for the test.
+    expected_file_path: str, required
+        The path of the file that contains the expected output for the test.
+    output : file, optional
+        The text file, open for writing and reading, that receives the produced output.
+    max_diffs : int, optional
+        The number of differences after which the comparison stops (None to find them all).
+    aligned: bool, optional
+        Indicates whether to align the outputs before listing differences (see aligned_diffs).
+
+    Returns
+    -------
+    case
+        A dict with the command, expected_file_path, error (stderr text), returncode, seconds (wall time),
+        peak_rss_kb (peak resident set size), diffs, truncated (whether the comparison stopped at max_diffs),
+        group (number of the first day group that differs, None if none does), perf (performance regression
+        message, see apply_baseline) and passed.
+    """
+    with (output or tempfile.TemporaryFile('w+')) as produced:
+        with tempfile.TemporaryFile('w+') as errors:
+            returncode, seconds, peak_rss_kb = perf_gate.run_measured(command, stdout=produced, stderr=errors)
+            errors.seek(0)
+            error = errors.read()
+        produced.seek(0)
+        fingerprint = fingerprint_lines(produced)
+        golden = fingerprint_manifest.expected_fingerprint(expected_file_path, fingerprint_file)
         diffs = []
-        # get the content of the files
-        produced_lines = read_file(file_to_generate)
-        expected_lines = read_file(expected_file_path)
-        # get the number of lines of produced and expected files
-        lines_produced = len(produced_lines)
-        lines_expected = len(expected_lines)
-        # get the list to navigate
-        list_to_navigate = None
-        if lines_produced >= lines_expected:
-            list_to_navigate = produced_lines
-        else:
-            list_to_navigate = expected_lines
-        # compare each line
-        for index in range(len(list_to_navigate)):
-            produced_line = 'N/A'
-            expected_line = 'N/A'
-            if index < lines_produced:
-                produced_line = produced_lines[index]
-            if index < lines_expected:
-                expected_line = expected_lines[index]
-            # format the lines
-            produced_line_formatted = format_line(produced_line)
-            expected_line_formatted = format_line(expected_line)
-            if not produced_line_formatted == expected_line_formatted:
-                    diffs.append((str(index+1), produced_line, expected_line))
-        # print results
-        if len(diffs) > 0:
-            result = False
-            print_message(is_error=False, message='TEST FAILED for ' + expected_file_path + '.')
-            if show_diffs:
-                 print_message(is_error=False, message='Differences shown below (line_index, produced_line, expected_line):')
-                 print(diffs)
+        truncated = False
+        group = None
+        # the expected file is only read when the produced output doesn't match its fingerprint
+        if fingerprint['hash'] != golden['hash']:
+            pairs = itertools.zip_longest(fingerprint['groups'], golden['groups'])
+            group = next(index+1 for index, (given, expected) in enumerate(pairs) if given != expected)
+            produced.seek(0)
+            with open(expected_file_path, 'r') as expected:
+                if aligned:
+                    diffs = aligned_diffs(list(produced), list(expected))
+                else:
+                    diffs = compare_lines(produced, expected)
+                diffs = list(itertools.islice(diffs, max_diffs))
+                truncated = max_diffs is not None and len(diffs) == max_diffs
+    return {
+        'command': command,
+        'expected_file_path': expected_file_path,
+        'error': error,
+        'returncode': returncode,
+        'seconds': seconds,
+        'peak_rss_kb': peak_rss_kb,
+        'diffs': diffs,
+        'truncated': truncated,
+        'group': group,
+        'perf': None,
+        'passed': returncode == 0 and len(diffs) == 0,
+    }
+
+
+def apply_baseline(case, baseline, record, tolerance):
+    """Allows to either record the runtime and peak RSS of a test into the baseline, or fail the test
+    if they regressed past the tolerance.
+
+    Parameters
+    ----------
+    case : dict, required
+        The result of the test (see run_case).
+    baseline : dict, required
+        See perf_gate.read_baseline; updated in place when recording.
+    record : bool, required
+        Indicates whether to record the test into the baseline instead of checking it.
+    tolerance : float, required
+        See perf_gate.check_performance.
+    """
+    if record:
+        if case['passed']:
+            baseline[case['command']] = {'seconds': case['seconds'], 'peak_rss_kb': case['peak_rss_kb']}
+    elif case['command'] in baseline:
+        case['perf'] = perf_gate.check_performance(case['seconds'], case['peak_rss_kb'], baseline[case['command']],
+                                                   tolerance)
+        if case['perf'] is not None:
+            case['passed'] = False
+
+
+def fingerprint_lines(lines):
+    """Allows to hash an output per file and per day group (the blocks separated by blank lines), reading it once.
+    Lines are normalized the way they are compared (see compare_lines): trailing newlines don't count.
+
+    Parameters
+    ----------
+    lines : Iterable, required
+        The lines of the output (e.g. an open file).
+
+    Returns
+    -------
+    fingerprint
+        A dict with the hash of the whole output and the list of hashes of its day groups.
+    """
+    whole = hashlib.blake2b(digest_size=16)
+    group = hashlib.blake2b(digest_size=16)
+    groups = []
+    for line in lines:
+        normalized = (line.rstrip('\n') + '\n').encode()
+        whole.update(normalized)
+        if normalized == b'\n':
+            groups.append(group.hexdigest())
+            group = hashlib.blake2b(digest_size=16)
         else:
-            print_message(is_error=False, message='TEST PASSED for ' + expected_file_path + '.')
-    return result      
+            group.update(normalized)
+    groups.append(group.hexdigest())
+    return {'hash': whole.hexdigest(), 'groups': groups}
 
 
-def read_file(file_path):
-    """Allows to read the lines of a text-based file.
+def fingerprint_file(file_path):
+    """Allows to get the fingerprint of a file (see fingerprint_lines).
 
     Parameters
     ----------
     file_path : str, required
-        The path to the file to read.
+        The path of the file to hash.
 
     Returns
     -------
-    lines
-        A list of strings tha represent the lines read.
+    fingerprint
+        See fingerprint_lines.
     """
-    lines = []
-    file = open(file_path, "r")
-    for line in file:
-        lines.append(line)
-    file.close()
-    return lines
+    with open(file_path, 'r') as file:
+        return fingerprint_lines(file)
+
+
+def compare_lines(produced_lines, expected_lines):
+    """Allows to compare the produced lines of a test against the expected ones, line by line.
+    Lines are read lazily, so the outputs never need to fit in memory.
+
+    Parameters
+    ----------
+    produced_lines : Iterable, required
+        The lines produced by the test (e.g. an open file).
+    expected_lines : Iterable, required
+        The expected lines.
+
+    Returns
+    -------
+    diffs
+        A generator of (line_index, produced_line, expected_line) tuples, 'N/A' standing for a missing line.
+    """
+    pairs = itertools.zip_longest(produced_lines, expected_lines, fillvalue='N/A')
+    for index, (produced_line, expected_line) in enumerate(pairs):
+        # trailing newlines don't count; comparing the raw lines is the same as comparing format_line's
+        if produced_line != expected_line and produced_line.rstrip('\n') != expected_line.rstrip('\n'):
+            yield (str(index+1), produced_line, expected_line)
+
+
+def aligned_diffs(produced_lines, expected_lines):
+    """Allows to compare the produced lines of a test against the expected ones after aligning them
+    (difflib), so that one missing or extra line is reported once instead of shifting every line after it.
+
+    Parameters
+    ----------
+    produced_lines : List, required
+        The lines produced by the test.
+    expected_lines : List, required
+        The expected lines.
+
+    Returns
+    -------
+    diffs
+        A generator of (line_index, produced_line, expected_line) tuples, 'N/A' standing for a missing line;
+        line_index is the line number in the produced output, or in the expected output for a missing line.
+    """
+    matcher = difflib.SequenceMatcher(None, [format_line(line) for line in produced_lines],
+                                      [format_line(line) for line in expected_lines], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        for i, j in itertools.zip_longest(range(i1, i2), range(j1, j2)):
+            if i is None:
+                yield (str(j+1), 'N/A', expected_lines[j])
+            elif j is None:
+                yield (str(i+1), produced_lines[i], 'N/A')
+            else:
+                yield (str(i+1), produced_lines[i], expected_lines[j])
+
+
+def print_case(case, show_diffs):
+    """Allows to print the result of a test.
+
+    Parameters
+    ----------
+    case : dict, required
+        The result of the test (see run_case).
+    show_diffs: bool, required
+        Indicates whether to show or not the list of differences found during the test.
+    """
+    if case['returncode'] != 0:
+        print_message(is_error=True, message=case['command'] + ' exited with status ' + str(case['returncode']) + '.')
+        if case['error']:
+            print(case['error'], end='')
+    timing = ' (' + format(case['seconds'], '.3f') + 's, ' + str(case['peak_rss_kb']) + ' KB)'
+    if case['passed']:
+        print_message(is_error=False, message='TEST PASSED for ' + case['expected_file_path'] + '.' + timing)
+    else:
+        print_message(is_error=False, message='TEST FAILED for ' + case['expected_file_path'] + '.' + timing)
+        if case['perf'] is not None:
+            print_message(is_error=False, message='Performance regression: ' + case['perf'] + '.')
+        if case['group'] is not None:
+            print_message(is_error=False, message='First differing day group: ' + str(case['group']) + '.')
+        if show_diffs and len(case['diffs']) > 0:
+            print_message(is_error=False, message='Differences shown below (line_index, produced_line, expected_line):')
+            print(case['diffs'])
+        if case['truncated']:
+            print_message(is_error=False, message='Stopped comparing after ' + str(len(case['diffs'])) + ' difference(s).')
 
 
 def format_line(line):
@@ -111,21 +298,54 @@ def format_line(line):
     return line.rstrip('\n').replace(" ", "%")
 
 
-def run_all(tests):
-    """Allows to run all the tests for the assignment.
+def run_all(tests, jobs=None, perf=False, record=False, tolerance=perf_gate.PERF_TOLERANCE):
+    """Allows to run all the tests for the assignment, several at a time. With perf, tests whose command has a
+    stored baseline also fail when their runtime or peak RSS regressed (see apply_baseline); tests running at the
+    same time slow each other down, so when checking or recording a baseline the tests run one at a time.
 
     Parameters
     ----------
     tests : List, required
         The list of tests to run.
+    jobs : int, optional
+        The number of tests to run at the same time (the number of cores by default, 1 with perf or record).
+    perf : bool, optional
+        Indicates whether to check the runtimes and peak RSS against the stored baseline.
+    record : bool, optional
+        Indicates whether to store the runtimes and peak RSS as the new baseline instead of checking them.
+    tolerance : float, optional
+        See perf_gate.check_performance.
+
+    Returns
+    -------
+    passed
+        Whether all the tests passed.
     """
-    num_passed = 0
-    for test in tests:
-        passed = run_one(command=test[0], expected_file_path=test[1], show_diffs=False)
-        if passed:
-            num_passed += 1
-        print('----------------------------------------------------------')
+    baseline = perf_gate.read_baseline() if perf or record else {}
+    if perf or record:
+        if jobs not in (None, 1):
+            print_message(is_error=False, message='Running the tests one at a time to measure them.')
+        jobs = 1
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+        futures = [pool.submit(run_case, test[0], test[1]) for test in tests]
+        # report in the order of the tests, as each one finishes
+        cases = []
+        for future in futures:
+            case = future.result()
+            apply_baseline(case, baseline, record, tolerance)
+            print_message(is_error=False, message='Ran "' + case['command'] + '" expecting ' + case['expected_file_path'] + '...')
+            print_case(case, show_diffs=False)
+            print('----------------------------------------------------------')
+            cases.append(case)
+    elapsed = time.perf_counter() - started
+    if record:
+        perf_gate.write_baseline(baseline)
+        print_message(is_error=False, message='Performance baseline written to ' + perf_gate.PERF_BASELINE + '.')
+    num_passed = sum(1 for case in cases if case['passed'])
     print_message(is_error=False, message='# tests passed: ' + str(num_passed) + '/' + str(len(tests)) + ' (' + str(int((num_passed/len(tests))*100)) + '%)')
+    print_message(is_error=False, message='wall time: ' + format(elapsed, '.3f') + 's (' + format(sum(case['seconds'] for case in cases), '.3f') + 's across tests)')
+    return num_passed == len(tests)
 
 
 def print_message(is_error, message):
@@ -153,6 +373,21 @@ def main():
     ----------
     test : int, optional
         Indicates if a specific test needs to be executed.
+    --jobs=N : optional
+        The number of tests to run at the same time when running all of them.
+    --aligned : optional
+        Aligns the outputs before listing the differences of a specific test (see aligned_diffs).
+    --perf : optional
+        Also fails the tests whose runtime or peak RSS regressed past the stored baseline (see apply_baseline).
+    --perf-record : optional
+        Stores the runtime and peak RSS of the passing tests as the performance baseline.
+    --perf-tolerance=F : optional
+        The fraction by which runtime and peak RSS may exceed the baseline (perf_gate.PERF_TOLERANCE by default).
+
+    Returns
+    -------
+    status
+        The exit status of the tester: 0 if all the tests run passed, 1 otherwise.
     """
     # relevant variables
     tests = [
@@ -168,12 +403,23 @@ def main():
     # validate compilation
     if not os.path.isfile(compiled_file_path):
         print_message(is_error=True, message='File ' + file_to_run + ' was not found. ' + 'Make sure to use make to compile your program first.')
+        return 1
     else:
-            if len(sys.argv) == 1:
-                run_all(tests=tests)       
+            options = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+            numbers = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+            record = '--perf-record' in options
+            tolerance = perf_gate.parse_tolerance(options)
+            if len(numbers) == 0:
+                jobs = [int(option[len('--jobs='):]) for option in options if option.startswith('--jobs=')]
+                passed = run_all(tests=tests, jobs=jobs[-1] if jobs else None, perf='--perf' in options,
+                                 record=record, tolerance=tolerance)
             else:
-                run_one(command=tests[int(sys.argv[1])-1][0], expected_file_path=tests[int(sys.argv[1])-1][1], show_diffs=True)
+                test = tests[int(numbers[0])-1]
+                passed = run_one(command=test[0], expected_file_path=test[1], show_diffs=True,
+                                 aligned='--aligned' in options, perf='--perf' in options, record=record,
+                                 tolerance=tolerance)
+            return 0 if passed else 1
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
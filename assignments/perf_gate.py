@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runtime and peak memory checks shared by the assignment testers.
+
+A tester runs each test command through run_measured and compares its wall time and peak RSS against a baseline
+stored next to the tests (PERF_BASELINE, see read_baseline): the test fails if either exceeds the baseline by more
+than a tolerance (see check_performance). Runs that are compared against each other must be measured the same way,
+one at a time, since tests running at the same time slow each other down.
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import resource
+import subprocess
+
+PERF_BASELINE = '.perf-baseline.json'
+PERF_TOLERANCE = 0.25
+PERF_TIME_SLACK = 0.05  # seconds, so that millisecond runs don't fail on timer noise
+PERF_RSS_SLACK = 2048  # KB
+PERF_POLL_INTERVAL = 0.005  # longest wait in seconds between two reads of the command's peak RSS
+PERF_FIRST_POLL = 0.0002  # first wait, doubled up to PERF_POLL_INTERVAL, so short commands are read too
+
+
+def run_measured(command, stdout=None, stderr=None):
+    """Runs a command and measures its wall time and peak memory.
+
+    The command runs without a shell, so the measured process is the program itself. On Linux the ru_maxrss that
+    os.wait4 reports for a child never goes below the RSS of the process that spawned it (the tester), so the
+    program's own high-water mark (VmHWM in /proc/<pid>/status) is polled while it runs, and ru_maxrss is only
+    trusted when it exceeds that floor. Growth in the last poll interval before the program exits can be missed,
+    which PERF_RSS_SLACK absorbs (a program that exits before its first read reports 0). Without /proc, ru_maxrss
+    is all there is.
+
+    Parameters
+    ----------
+    command : str, required
+        The command to run, split like a shell would (no pipes or redirections).
+    stdout : file, optional
+        The file that receives the output of the command (the tester's by default).
+    stderr : file, optional
+        The file that receives the errors of the command (the tester's by default).
+
+    Returns
+    -------
+    returncode, seconds, peak_rss_kb
+        The exit status, the wall time in seconds and the peak resident set size in KB of the command. A program
+        that cannot be started gets status 127 if it is missing and 126 otherwise, as from a shell, and the
+        reason is written to stderr.
+    """
+    floor = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    # Popen returns once the program is executing, so the reads below are of the program, not of a copy of the tester
+    try:
+        process = subprocess.Popen(shlex.split(command), stdout=stdout, stderr=stderr)
+    except OSError as error:
+        (stderr or sys.stderr).write(command + ': ' + (error.strerror or str(error)) + '\n')
+        return 127 if isinstance(error, FileNotFoundError) else 126, time.perf_counter() - started, 0
+    polled = read_peak_rss(process.pid)
+    wait = PERF_FIRST_POLL
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        time.sleep(wait)
+        wait = min(wait * 2, PERF_POLL_INTERVAL)
+        polled = max(polled, read_peak_rss(process.pid) or 0)
+    seconds = time.perf_counter() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    if sys.platform == 'darwin':
+        return process.returncode, seconds, usage.ru_maxrss // 1024
+    if polled is None or usage.ru_maxrss > floor:
+        return process.returncode, seconds, usage.ru_maxrss
+    return process.returncode, seconds, polled
+
+
+def read_peak_rss(pid):
+    """Reads the peak resident set size of a running process from /proc.
+
+    Parameters
+    ----------
+    pid : int, required
+        The process id.
+
+    Returns
+    -------
+    peak_rss_kb
+        The VmHWM of the process in KB, 0 if the process already exited, None if there is no /proc.
+    """
+    try:
+        with open('/proc/' + str(pid) + '/status', 'r') as stream:
+            for line in stream:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        return None if not os.path.isdir('/proc/self') else 0
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def read_baseline(path=PERF_BASELINE):
+    """Gets the stored runtime and peak RSS of each test command.
+
+    Parameters
+    ----------
+    path : str, optional
+        The path of the baseline file.
+
+    Returns
+    -------
+    baseline
+        A dict of command to {'seconds': float, 'peak_rss_kb': int} (empty if there is no baseline yet).
+    """
+    try:
+        with open(path, 'r') as stream:
+            return json.load(stream)['cases']
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def write_baseline(baseline, path=PERF_BASELINE):
+    """Stores the runtime and peak RSS of each test command.
+
+    Parameters
+    ----------
+    baseline : dict, required
+        See read_baseline.
+    path : str, optional
+        The path of the baseline file.
+    """
+    with open(path, 'w') as stream:
+        json.dump({'cases': baseline}, stream, indent=1, sort_keys=True)
+
+
+def check_performance(seconds, peak_rss_kb, expected, tolerance=PERF_TOLERANCE):
+    """Compares the runtime and peak RSS of a test against its baseline.
+
+    Parameters
+    ----------
+    seconds : float, required
+        The wall time of the test.
+    peak_rss_kb : int, required
+        The peak resident set size of the test, in KB.
+    expected : dict, required
+        The baseline of the test (see read_baseline).
+    tolerance : float, optional
+        The fraction by which runtime and peak RSS may exceed the baseline, on top of PERF_TIME_SLACK
+        and PERF_RSS_SLACK.
+
+    Returns
+    -------
+    message
+        A description of the regressions, None if there are none.
+    """
+    regressions = []
+    if seconds > expected['seconds'] * (1 + tolerance) + PERF_TIME_SLACK:
+        regressions.append('runtime ' + format(seconds, '.3f') + 's (baseline ' + format(expected['seconds'], '.3f') + 's)')
+    if peak_rss_kb > expected['peak_rss_kb'] * (1 + tolerance) + PERF_RSS_SLACK:
+        regressions.append('peak RSS ' + str(peak_rss_kb) + ' KB (baseline ' + str(expected['peak_rss_kb']) + ' KB)')
+    return ', '.join(regressions) or None
+
+
+def parse_tolerance(options):
+    """Gets the tolerance given by the last --perf-tolerance=F option.
+
+    Parameters
+    ----------
+    options : List, required
+        The command line options.
+
+    Returns
+    -------
+    tolerance
+        The tolerance, PERF_TOLERANCE if none was given.
+    """
+    tolerances = [float(option[len('--perf-tolerance='):]) for option in options
+                  if option.startswith('--perf-tolerance=')]
+    return tolerances[-1] if tolerances else PERF_TOLERANCE